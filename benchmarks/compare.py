@@ -0,0 +1,69 @@
+"""
+Compare two benchmark result files from benchmarks/run.py
+
+    python benchmarks/compare.py before.json after.json
+
+Exits non-zero when any benchmark got slower than --tolerance allows.
+"""
+
+import argparse
+import json
+import sys
+
+
+def key(result: dict) -> tuple:
+    return result["benchmark"], result["comparison"], result["size"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown before failing, 0.2 is 20%% slower",
+    )
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = {key(result): result for result in json.load(f)["results"]}
+
+    with open(args.after) as f:
+        after = {key(result): result for result in json.load(f)["results"]}
+
+    regressed = False
+
+    for name in sorted(before.keys() & after.keys()):
+        old, new = before[name]["seconds"], after[name]["seconds"]
+        ratio = new / old if old else float("inf")
+        flag = ""
+
+        if ratio > 1 + args.tolerance:
+            flag = "  REGRESSION"
+            regressed = True
+
+        print(
+            "%-10s %-20s %7d %10.6fs %10.6fs %6.2fx%s" % (*name, old, new, ratio, flag)
+        )
+
+        # a faster matcher that finds different cousins isn't an improvement
+        if before[name].get("matches") != after[name].get("matches"):
+            print(
+                "    matches changed: %s -> %s"
+                % (before[name].get("matches"), after[name].get("matches"))
+            )
+
+        # only in replays
+        if before[name].get("statements") != after[name].get("statements"):
+            print(
+                "    statements changed: %s -> %s"
+                % (before[name].get("statements"), after[name].get("statements"))
+            )
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+Replay recorded review sessions against a copy of a collection
+
+    python benchmarks/replay.py sessions.jsonl collection.anki2 --output after.json
+
+Sessions are recorded with the "record review sessions" option. Each answer is
+passed to buryCousins in the order it was taken, through a scheduler that only
+keeps the queues, so the timings are of the add-on alone. The collection is
+copied first since cousins get buried along the way.
+
+Needs the same anki package the add-on runs on, but not aqt or Qt, which are
+stood in for by a module without a main window. Results are written in the
+format of benchmarks/run.py so benchmarks/compare.py can gate on them.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import types
+from typing import Any, Dict, List, Set
+
+from anki import Collection
+from anki.consts import QUEUE_TYPE_NEW, QUEUE_TYPE_REV
+from anki.utils import ids2str
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+
+# cards anki's v2 scheduler fetches into a queue at a time
+QUEUE_LIMIT = 50
+
+sys.path.insert(0, SRC)
+
+from instrumentation import _percentile, read_session_log  # noqa: E402
+
+
+def load_addon() -> types.ModuleType:
+    """src/main.py without running src/__init__.py, which patches Anki's GUI"""
+    package = types.ModuleType("anki_cousins")
+    package.__path__ = [SRC]  # type: ignore
+    sys.modules["anki_cousins"] = package
+
+    # main only uses the main window for background matching and Find
+    # Duplicates' progress, neither of which is replayed, and tooltips need
+    # a running Qt application
+    aqt = types.ModuleType("aqt")
+    aqt.mw = None  # type: ignore
+    aqt.utils = types.ModuleType("aqt.utils")  # type: ignore
+    aqt.utils.tooltip = lambda *args, **kwargs: None  # type: ignore
+    sys.modules["aqt"] = aqt
+    sys.modules["aqt.utils"] = aqt.utils  # type: ignore
+
+    return importlib.import_module("anki_cousins.main")
+
+
+class CountingDB:
+    """col.db, counting the statements run through it"""
+
+    def __init__(self, db: Any):
+        self._db = db
+        self.statements = 0
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._db, name)
+
+        if name not in ("execute", "executemany", "scalar", "all", "list", "first"):
+            return attribute
+
+        def counted(*args, **kwargs):
+            self.statements += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+class ReplayScheduler:
+    """the parts of the v2 scheduler buryCousins uses
+
+    The counts come from the collection's scheduler on reset. Like Anki, the
+    queues hold at most QUEUE_LIMIT cards and are filled again when they run
+    out, then drained by the recorded answers so they shrink the way they did
+    during the session.
+    """
+
+    def __init__(self, col: Collection):
+        self.col = col
+        self.today = col.sched.today
+        self._revQueue: List[int] = []
+        self._newQueue: List[int] = []
+        self.revCount = 0
+        self.newCount = 0
+
+        # answers aren't written to the copy, so their cards would come back
+        self._taken: Set[int] = set()
+
+    def reset(self) -> None:
+        self.col.sched.reset()
+        self.newCount, _, self.revCount = self.col.sched.counts()
+        self._revQueue = []
+        self._newQueue = []
+        self._taken = set()
+
+    def take(self, card: Any) -> None:
+        """remove an answered card from its queue like getCard does"""
+        if card.queue == QUEUE_TYPE_REV:
+            if not self._revQueue:
+                self._revQueue = self._fill(QUEUE_TYPE_REV, self.revCount)
+
+            self._remove(self._revQueue, card.id)
+            self.revCount -= 1
+        elif card.queue == QUEUE_TYPE_NEW:
+            if not self._newQueue:
+                self._newQueue = self._fill(QUEUE_TYPE_NEW, self.newCount)
+
+            self._remove(self._newQueue, card.id)
+            self.newCount -= 1
+
+        self._taken.add(card.id)
+
+    def _fill(self, queue: int, count: int) -> List[int]:
+        limit = min(QUEUE_LIMIT, count)
+        in_decks = f"did in {ids2str(self.col.decks.active())}"
+        due = f"and due<={self.today}" if queue == QUEUE_TYPE_REV else ""
+
+        card_ids = self.col.db.list(
+            f"select id from cards where {in_decks} and queue={queue} {due} "
+            "order by due limit ?",
+            limit + len(self._taken),
+        )
+
+        return [card_id for card_id in card_ids if card_id not in self._taken][:limit]
+
+    @staticmethod
+    def _remove(queue: List[int], card_id: int) -> None:
+        if card_id in queue:
+            queue.remove(card_id)
+        elif queue:
+            # anki breaks ties between reviews at random, so the card may not
+            # have made it into this batch here
+            queue.pop()
+
+    def _newConf(self, card: Any) -> Dict[str, Any]:
+        return self.col.decks.confForDid(card.odid or card.did).get("new", {})
+
+    def _revConf(self, card: Any) -> Dict[str, Any]:
+        return self.col.decks.confForDid(card.odid or card.did).get("rev", {})
+
+
+def configure(main: types.ModuleType, col: Collection, event: Dict[str, Any]) -> None:
+    """the rules and options from a recorded reset"""
+    settings = main.SettingsManager(col)
+    settings.save([settings._deserialize_rule(row) for row in event["rules"]])
+
+    options = {
+        key: value
+        for key, value in event["options"].items()
+        if key in main.Options._fields
+    }
+    # results are only reported here, background matching needs the GUI and
+    # cached matches would be read from and written to the add-on's own files
+    options.update(
+        record_sessions=False,
+        log_timings=False,
+        background_matching=False,
+        cache_matches=False,
+    )
+    settings.save_options(main.Options(**options))
+
+    col.decks.select(event["deck"])
+
+
+def replay(
+    main: types.ModuleType, col: Collection, events: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    db = col.db = CountingDB(col.db)
+    scheduler = ReplayScheduler(col)
+
+    answer_seconds: List[float] = []
+    reset_seconds: List[float] = []
+    answer_statements = 0
+    reset_statements = 0
+    missing = 0
+    buried = 0
+    diverged = 0
+
+    for event in events:
+        if event["event"] == "reset":
+            configure(main, col, event)
+            scheduler.reset()
+
+            statements = db.statements
+            start = time.perf_counter()
+            main.resetCousins(scheduler)
+            reset_seconds.append(time.perf_counter() - start)
+            reset_statements += db.statements - statements
+
+            continue
+
+        try:
+            card = col.getCard(event["card"])
+        except Exception:
+            # deleted since the session was recorded
+            missing += 1
+            continue
+
+        scheduler.take(card)
+        queued = scheduler.revCount + scheduler.newCount
+
+        recorded = (event.get("rev_queue", -1), event.get("new_queue", -1))
+        replayed = (len(scheduler._revQueue), len(scheduler._newQueue))
+
+        if -1 not in recorded and recorded != replayed:
+            # the collection has changed since, or the session was recorded
+            # with a scheduler that builds its queues differently
+            if not diverged:
+                print(
+                    "card %d answered with queues of %d review and %d new cards, "
+                    "recorded as %d and %d" % (card.id, *replayed, *recorded),
+                    file=sys.stderr,
+                )
+
+            diverged += 1
+
+        statements = db.statements
+        start = time.perf_counter()
+        main.buryCousins(scheduler, card)
+        answer_seconds.append(time.perf_counter() - start)
+        answer_statements += db.statements - statements
+
+        # cousins are taken out of the queues as they're buried
+        buried += queued - scheduler.revCount - scheduler.newCount
+
+    return {
+        "answers": answer_seconds,
+        "resets": reset_seconds,
+        "answer_statements": answer_statements,
+        "reset_statements": reset_statements,
+        "missing": missing,
+        "buried": buried,
+        "diverged": diverged,
+    }
+
+
+def results(replayed: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """percentiles as benchmarks/run.py results, with the size as the count"""
+    answers = sorted(replayed["answers"])
+    resets = sorted(replayed["resets"])
+    rows = []
+
+    for benchmark, seconds, statements in (
+        ("replay_answer", answers, replayed["answer_statements"]),
+        ("replay_reset", resets, replayed["reset_statements"]),
+    ):
+        if not seconds:
+            continue
+
+        for percent in (50, 95, 99):
+            rows.append(
+                {
+                    "benchmark": benchmark,
+                    "comparison": f"p{percent}",
+                    "size": len(seconds),
+                    "seconds": _percentile(seconds, percent),
+                    # compare.py flags runs that bury different cards
+                    "matches": replayed["buried"],
+                    "statements": statements,
+                }
+            )
+
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("sessions", help="user_files/sessions.jsonl")
+    parser.add_argument("collection", help="collection to replay against")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    args = parser.parse_args()
+
+    events = list(read_session_log(args.sessions))
+
+    if not events or events[0]["event"] != "reset":
+        # the rules in use are recorded when the queues are built
+        parser.error("sessions should start with a queue rebuild")
+
+    addon = load_addon()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "collection.anki2")
+        shutil.copy(args.collection, path)
+
+        col = Collection(path)
+
+        try:
+            replayed = replay(addon, col, events)
+        finally:
+            col.close(save=False)
+
+    rows = results(replayed)
+
+    for row in rows:
+        print(
+            "%-14s %-4s %6d %10.6fs"
+            % (row["benchmark"], row["comparison"], row["size"], row["seconds"]),
+            file=sys.stderr,
+        )
+
+    print(
+        "%d statements over %d answers, %d cards buried, %d answers skipped"
+        % (
+            replayed["answer_statements"],
+            len(replayed["answers"]),
+            replayed["buried"],
+            replayed["missing"],
+        ),
+        file=sys.stderr,
+    )
+
+    if replayed["diverged"]:
+        print(
+            "warning: queues differed from the recording at %d answers, so "
+            "the timings may not compare" % replayed["diverged"],
+            file=sys.stderr,
+        )
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "sessions": os.path.basename(args.sessions),
+        "results": rows,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Time the matching rules against synthetic collections, without Anki
+
+    python benchmarks/run.py --sizes 1000 10000 --output results.json
+
+Results are written as JSON so runs from different commits can be compared
+with benchmarks/compare.py.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Callable, DefaultDict, Dict, List, Tuple
+
+# the matching code doesn't need anki, but the add-on package does
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from synthetic import (  # noqa: E402
+    BASIC_FIELDS,
+    BASIC_MODEL_ID,
+    CLOZE_FIELDS,
+    CLOZE_MODEL_ID,
+    NoteGenerator,
+    SyntheticNote,
+)
+from matching import (  # noqa: E402
+    Comparisons,
+    MatchRule,
+    duplicate_groups,
+    strip_html,
+)
+
+# one representative rule per comparison, in the way they tend to get used
+RULES = {
+    Comparisons.similarity: MatchRule(
+        CLOZE_MODEL_ID, "Text", CLOZE_MODEL_ID, "Text", Comparisons.similarity, 0.8
+    ),
+    Comparisons.prefix: MatchRule(
+        BASIC_MODEL_ID, "Front", BASIC_MODEL_ID, "Front", Comparisons.prefix, 0.7
+    ),
+    Comparisons.contains: MatchRule(
+        CLOZE_MODEL_ID, "Text", BASIC_MODEL_ID, "Back", Comparisons.contains, 1
+    ),
+    Comparisons.contained_by: MatchRule(
+        BASIC_MODEL_ID, "Back", CLOZE_MODEL_ID, "Text", Comparisons.contained_by, 1
+    ),
+    Comparisons.cloze_contained_by: MatchRule(
+        CLOZE_MODEL_ID,
+        "Text",
+        BASIC_MODEL_ID,
+        "Front",
+        Comparisons.cloze_contained_by,
+        1,
+    ),
+    Comparisons.tfidf: MatchRule(
+        CLOZE_MODEL_ID, "Text", CLOZE_MODEL_ID, "Text", Comparisons.tfidf, 0.8
+    ),
+}
+
+FIELD_NAMES = {BASIC_MODEL_ID: BASIC_FIELDS, CLOZE_MODEL_ID: CLOZE_FIELDS}
+
+
+def field_values(
+    notes: Dict[int, List[SyntheticNote]], model_id: int, field_name: str
+) -> List[Tuple[int, str]]:
+    field_number = FIELD_NAMES[model_id].index(field_name)
+
+    return [(note.id, note.fields[field_number]) for note in notes[model_id]]
+
+
+def timed(function: Callable, repeat: int) -> Tuple[float, object]:
+    """best wall time of repeat runs and the result of the last one"""
+    best = float("inf")
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def review(rule: MatchRule, notes, samples: int) -> float:
+    """mean time to match one answered note against every scheduled note"""
+    my_values = [
+        value for _, value in field_values(notes, rule.my_note_model_id, rule.my_field)
+    ]
+    cousin_values = [
+        value
+        for _, value in field_values(
+            notes, rule.cousin_note_model_id, rule.cousin_field
+        )
+    ]
+
+    step = max(1, len(my_values) // samples)
+    answered = my_values[::step][:samples]
+
+    start = time.perf_counter()
+
+    for my_value in answered:
+        rule.test([my_value], cousin_values)
+
+    return (time.perf_counter() - start) / len(answered)
+
+
+def find_dupes(rule: MatchRule, notes) -> Tuple[int, int]:
+    """same steps as findDupes: strip html, map values to notes, match, group"""
+
+    def mapping(model_id: int, field_name: str) -> Dict[str, List[int]]:
+        values: DefaultDict[str, List[int]] = defaultdict(list)
+
+        for note_id, value in field_values(notes, model_id, field_name):
+            values[strip_html(value)].append(note_id)
+
+        return values
+
+    my_mapping = mapping(rule.my_note_model_id, rule.my_field)
+    cousin_mapping = mapping(rule.cousin_note_model_id, rule.cousin_field)
+
+    matches = rule.test(list(my_mapping), list(cousin_mapping))
+    groups = duplicate_groups(rule, matches, my_mapping, cousin_mapping)
+
+    return len(matches), len(groups)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(__file__),
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument(
+        "--comparisons",
+        nargs="+",
+        choices=[comparison.name for comparison in RULES],
+        default=[comparison.name for comparison in RULES],
+    )
+    parser.add_argument("--duplicate-rate", type=float, default=0.01)
+    parser.add_argument("--near-duplicate-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--review-samples",
+        type=int,
+        default=20,
+        help="answered notes timed per review benchmark",
+    )
+    parser.add_argument(
+        "--max-dupes-size",
+        type=int,
+        default=2000,
+        help="skip find duplicates benchmarks on bigger collections",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", help="write results here instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+
+    for size in args.sizes:
+        generator = NoteGenerator(
+            seed=args.seed,
+            duplicate_rate=args.duplicate_rate,
+            near_duplicate_rate=args.near_duplicate_rate,
+        )
+        # half of each note type
+        notes = {
+            BASIC_MODEL_ID: list(generator.basic(size // 2)),
+            CLOZE_MODEL_ID: list(generator.cloze(size - size // 2)),
+        }
+
+        for name in args.comparisons:
+            rule = RULES[Comparisons[name]]
+            base = {"comparison": name, "size": size, "threshold": rule.threshold}
+
+            seconds = review(rule, notes, args.review_samples)
+            results.append({"benchmark": "review", **base, "seconds": seconds})
+            print(
+                "review      %-20s %7d %10.6fs" % (name, size, seconds), file=sys.stderr
+            )
+
+            if size > args.max_dupes_size:
+                continue
+
+            seconds, (matches, groups) = timed(  # type: ignore
+                lambda: find_dupes(rule, notes), args.repeat
+            )
+            results.append(
+                {
+                    "benchmark": "find_dupes",
+                    **base,
+                    "seconds": seconds,
+                    "matches": matches,
+                    "groups": groups,
+                }
+            )
+            print(
+                "find_dupes  %-20s %7d %10.6fs" % (name, size, seconds), file=sys.stderr
+            )
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "seed": args.seed,
+        "duplicate_rate": args.duplicate_rate,
+        "near_duplicate_rate": args.near_duplicate_rate,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Synthetic Basic and Cloze notes for benchmarking without Anki
+
+Notes look roughly like real cards: short Basic fronts and backs, Cloze texts
+with one or two deletions and a little HTML. A fraction of notes copy an
+earlier note exactly or with a small edit so the matchers have something to
+find.
+"""
+
+import random
+from typing import Iterator, List, NamedTuple
+
+BASIC_MODEL_ID = 1
+CLOZE_MODEL_ID = 2
+
+BASIC_FIELDS = ["Front", "Back"]
+CLOZE_FIELDS = ["Text", "Extra"]
+
+# consonant-vowel pairs plus a few clusters, so text shares about as many
+# character pairs as real text does
+SYLLABLES = [c + v for c in "bcdfghjklmnprstvwz" for v in "aeiou"] + [
+    "th", "st", "ch", "sh", "tr", "ng", "ion", "er", "an", "en", "qu",
+]  # fmt: skip
+
+
+class SyntheticNote(NamedTuple):
+    id: int
+    mid: int
+    fields: List[str]
+
+    @property
+    def flds(self) -> str:
+        """fields joined like the flds column of the notes table"""
+        return "\x1f".join(self.fields)
+
+
+class NoteGenerator:
+    """
+    >>> notes = list(NoteGenerator(seed=1).basic(3))
+    >>> [note.id for note in notes]
+    [1, 2, 3]
+
+    >>> list(NoteGenerator(seed=1).basic(3)) == notes
+    True
+
+    >>> all("{{c1::" in note.fields[0] for note in NoteGenerator().cloze(5))
+    True
+    """
+
+    def __init__(
+        self,
+        seed: int = 0,
+        vocabulary_size: int = 20000,
+        duplicate_rate: float = 0.01,
+        near_duplicate_rate: float = 0.05,
+    ):
+        self.random = random.Random(seed)
+        self.duplicate_rate = duplicate_rate
+        self.near_duplicate_rate = near_duplicate_rate
+        self.vocabulary = sorted(
+            {self._word() for _ in range(vocabulary_size)}, key=len
+        )
+        self._next_id = 1
+
+    def _word(self) -> str:
+        return "".join(
+            self.random.choice(SYLLABLES) for _ in range(self.random.randint(1, 4))
+        )
+
+    def _words(self, low: int, high: int) -> List[str]:
+        return [
+            self.random.choice(self.vocabulary)
+            for _ in range(self.random.randint(low, high))
+        ]
+
+    def _edit(self, text: str) -> str:
+        """small typo-like change to a single character"""
+        i = self.random.randrange(len(text))
+        action = self.random.choice(["insert", "delete", "replace"])
+
+        if action == "insert":
+            return text[:i] + self.random.choice("aeiou") + text[i:]
+        elif action == "delete":
+            return text[:i] + text[i + 1 :]
+
+        return text[:i] + self.random.choice("aeiou") + text[i + 1 :]
+
+    def _notes(self, mid: int, count: int, make_fields) -> Iterator[SyntheticNote]:
+        made: List[List[str]] = []
+
+        for _ in range(count):
+            roll = self.random.random()
+
+            if made and roll < self.duplicate_rate:
+                fields = list(self.random.choice(made))
+            elif made and roll < self.duplicate_rate + self.near_duplicate_rate:
+                original = self.random.choice(made)
+                fields = [self._edit(original[0])] + original[1:]
+            else:
+                fields = make_fields()
+
+            made.append(fields)
+
+            yield SyntheticNote(self._next_id, mid, fields)
+            self._next_id += 1
+
+    def basic(self, count: int) -> Iterator[SyntheticNote]:
+        def fields() -> List[str]:
+            return [" ".join(self._words(2, 8)), self.random.choice(self.vocabulary)]
+
+        return self._notes(BASIC_MODEL_ID, count, fields)
+
+    def cloze(self, count: int) -> Iterator[SyntheticNote]:
+        def fields() -> List[str]:
+            words = self._words(6, 25)
+
+            for number, i in enumerate(
+                self.random.sample(range(len(words)), min(2, len(words))), 1
+            ):
+                hint = "::hint" if self.random.random() < 0.2 else ""
+                words[i] = "{{c%d::%s%s}}" % (number, words[i], hint)
+
+            text = " ".join(words)
+
+            if self.random.random() < 0.3:
+                text = "<b>%s</b>&nbsp;%s" % (words[0], " ".join(words[1:]))
+
+            return [text, " ".join(self._words(0, 5))]
+
+        return self._notes(CLOZE_MODEL_ID, count, fields)
@@ -0,0 +1,337 @@
+"""
+Run the cousin rules against a collection file, without Anki
+
+    python cli.py collection.anki2 --report groups --format jsonl > cousins.jsonl
+
+The collection is opened read-only, so it's safest to point this at a copy of
+collection.anki2 rather than the file of a running Anki. Rules are read from
+the add-on's config in the collection. Scopes need Anki's search, so every
+rule is matched against the whole collection.
+"""
+
+import argparse
+import csv
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+from collections import defaultdict
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+# the matching code doesn't need anki, but the add-on package does
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "src"))
+
+from columns import FieldColumn  # noqa: E402
+from graph import merge_groups  # noqa: E402
+from matching import (  # noqa: E402
+    CompiledRule,
+    Comparisons,
+    MatchRule,
+    RuleSet,
+    clear_cached_indexes,
+    duplicate_groups,
+    strip_html,
+)
+from parallel import parallel_test  # noqa: E402
+
+# same key as SettingsManager.key
+RULES_KEY = "anki_cousins"
+
+# bytes of the collection memory-mapped instead of read through sqlite's cache
+MMAP_SIZE = 1 << 30
+
+Models = Dict[int, Dict[str, Any]]  # model id: {"name": ..., "flds": [...]}
+
+
+def connect(path: str) -> sqlite3.Connection:
+    # a uri so sqlite refuses to write, even by accident. as_uri escapes
+    # characters like # and % that would end or change the path
+    uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+    db = sqlite3.connect(uri, uri=True)
+    db.execute(f"pragma mmap_size = {MMAP_SIZE}")
+
+    return db
+
+
+def _has_table(db: sqlite3.Connection, name: str) -> bool:
+    return bool(
+        db.execute(
+            "select 1 from sqlite_master where type = 'table' and name = ?", (name,)
+        ).fetchone()
+    )
+
+
+def load_rules(db: sqlite3.Connection) -> List[MatchRule]:
+    """rules saved by the add-on, from either collection schema"""
+    if _has_table(db, "config"):
+        # Anki>=2.1.28
+        row = db.execute(
+            "select val from config where key = ?", (RULES_KEY,)
+        ).fetchone()
+        stored = json.loads(row[0]) if row else []
+    else:
+        (conf,) = db.execute("select conf from col").fetchone()
+        stored = json.loads(conf).get(RULES_KEY, [])
+
+    rules = []
+
+    for row in stored:
+        # same as SettingsManager._deserialize_rule
+        rule_dict = dict(zip(MatchRule._fields, row))
+
+        try:
+            comparison = Comparisons[rule_dict.pop("comparison")]
+        except KeyError:
+            print(f"skipping rule from a newer version: {row}", file=sys.stderr)
+            continue
+
+        rules.append(MatchRule(comparison=comparison, **rule_dict))  # type: ignore
+
+    return rules
+
+
+def load_models(db: sqlite3.Connection) -> Models:
+    """names and fields of every note type, from either collection schema"""
+    if _has_table(db, "notetypes"):
+        # Anki>=2.1.28
+        models: Models = {
+            model_id: {"name": name, "flds": []}
+            for model_id, name in db.execute("select id, name from notetypes")
+        }
+
+        for model_id, field_ord, field_name in db.execute(
+            "select ntid, ord, name from fields order by ntid, ord"
+        ):
+            models[model_id]["flds"].append({"name": field_name, "ord": field_ord})
+
+        return models
+
+    (stored,) = db.execute("select models from col").fetchone()
+
+    return {int(model_id): model for model_id, model in json.loads(stored).items()}
+
+
+def extract_columns(
+    db: sqlite3.Connection, model_id: int, field_ords: Set[int]
+) -> Dict[int, FieldColumn]:
+    """a column for each field ord, scanning the note type's notes once"""
+    columns = {field_ord: FieldColumn() for field_ord in field_ords}
+
+    for note_id, mod, fields in db.execute(
+        "select id, mod, flds from notes where mid = ?", (model_id,)
+    ):
+        values = fields.split("\x1f")
+
+        for field_ord, column in columns.items():
+            column.append(note_id, mod, strip_html(values[field_ord]))
+
+    return columns
+
+
+class Columns:
+    """field columns shared by the rules, dropped after the last rule using them
+
+    Every field of a note type that's used by any rule is read in one scan.
+    """
+
+    def __init__(self, db: sqlite3.Connection, rules: List[CompiledRule]):
+        self.db = db
+        self.columns: Dict[int, Dict[int, FieldColumn]] = {}
+        self.planned: DefaultDict[int, Set[int]] = defaultdict(set)
+        self.last_use: Dict[int, int] = {}  # model id: index of the last rule
+
+        for index, compiled in enumerate(rules):
+            for model_id, field_ord in self.fields(compiled):
+                self.planned[model_id].add(field_ord)
+                self.last_use[model_id] = index
+
+    @staticmethod
+    def fields(compiled: CompiledRule) -> List[Tuple[int, int]]:
+        return [
+            (compiled.rule.my_note_model_id, compiled.my_field_number),
+            (compiled.rule.cousin_note_model_id, compiled.cousin_field_number),
+        ]
+
+    def column(self, model_id: int, field_ord: int) -> FieldColumn:
+        if model_id not in self.columns:
+            self.columns[model_id] = extract_columns(
+                self.db, model_id, self.planned[model_id]
+            )
+
+        return self.columns[model_id][field_ord]
+
+    def done(self, index: int) -> None:
+        """forget the columns no rule after index uses"""
+        for model_id, last_use in self.last_use.items():
+            if last_use <= index:
+                self.columns.pop(model_id, None)
+
+
+def rule_label(rule: MatchRule, models: Models) -> str:
+    return "%s.%s %s %s.%s %g" % (
+        models[rule.my_note_model_id]["name"],
+        rule.my_field,
+        rule.comparison.name,
+        models[rule.cousin_note_model_id]["name"],
+        rule.cousin_field,
+        rule.threshold,
+    )
+
+
+def note_pairs(
+    matches: Iterable[Tuple[str, str]],
+    my_column: FieldColumn,
+    cousin_column: FieldColumn,
+) -> Iterator[Tuple[int, int]]:
+    """(my note id, cousin note id) for each matched pair of values"""
+    for my_value, cousin_value in matches:
+        for my_note_id in my_column[my_value]:
+            for cousin_note_id in cousin_column[cousin_value]:
+                if my_note_id != cousin_note_id:
+                    yield my_note_id, cousin_note_id
+
+
+class Writer:
+    """records as JSON lines or CSV rows"""
+
+    def __init__(self, output: TextIO, format: str, fields: List[str]):
+        self.output = output
+        self.fields = fields
+        self.csv = None
+
+        if format == "csv":
+            self.csv = csv.writer(output)
+            self.csv.writerow(fields)
+
+    def write(self, *values: Any) -> None:
+        if self.csv is None:
+            self.output.write(json.dumps(dict(zip(self.fields, values))) + "\n")
+        else:
+            self.csv.writerow(
+                [
+                    " ".join(map(str, value)) if isinstance(value, list) else value
+                    for value in values
+                ]
+            )
+
+
+def run(
+    db: sqlite3.Connection,
+    report: str,
+    writer: Writer,
+    workers: int,
+    cluster: bool,
+) -> None:
+    models = load_models(db)
+    rule_set = RuleSet(load_rules(db), models.get)
+    columns = Columns(db, rule_set.rules)
+
+    # (rule, label, note ids) for clustering once every rule is done
+    groups: List[Tuple[str, str, List[int]]] = []
+
+    for index, compiled in enumerate(rule_set.rules):
+        rule = compiled.rule
+        label = rule_label(rule, models)
+
+        if rule.scope:
+            print(f"ignoring the scope of {label}", file=sys.stderr)
+
+        my_column = columns.column(rule.my_note_model_id, compiled.my_field_number)
+        cousin_column = columns.column(
+            rule.cousin_note_model_id, compiled.cousin_field_number
+        )
+
+        matches = parallel_test(
+            rule, my_column.distinct_values, cousin_column.distinct_values, workers
+        )
+
+        if report == "pairs":
+            for my_note_id, cousin_note_id in note_pairs(
+                matches, my_column, cousin_column
+            ):
+                writer.write(label, my_note_id, cousin_note_id)
+        else:
+            for key, note_ids in duplicate_groups(
+                rule, matches, my_column, cousin_column
+            ).items():
+                # keys look like "[rule] value"
+                value = key.partition("] ")[2]
+
+                if cluster:
+                    groups.append((rule.comparison.name, value, sorted(note_ids)))
+                else:
+                    writer.write(label, value, sorted(note_ids))
+
+        columns.done(index)
+        clear_cached_indexes()
+
+        print(f"matched {label}", file=sys.stderr)
+
+    for key, note_ids in merge_groups(groups):
+        # labelled "[rule, rule] value"
+        rules, _, value = key[1:].partition("] ")
+        writer.write(rules, value, note_ids)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("collection", help="path to a copy of collection.anki2")
+    parser.add_argument(
+        "--report",
+        choices=["groups", "pairs"],
+        default="groups",
+        help="duplicate groups like Find Duplicates, or every pair of cousins",
+    )
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processes to match each rule with. 0 is one per core",
+    )
+    parser.add_argument(
+        "--cluster",
+        action="store_true",
+        help="merge groups sharing any note, like the Find Duplicates option",
+    )
+    parser.add_argument("--output", help="write here instead of stdout")
+    args = parser.parse_args()
+
+    if args.report == "pairs":
+        fields = ["rule", "note", "cousin"]
+    else:
+        fields = ["rule", "value", "notes"]
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+
+    try:
+        db = connect(args.collection)
+
+        try:
+            run(
+                db,
+                args.report,
+                Writer(output, args.format, fields),
+                args.workers,
+                args.cluster and args.report == "groups",
+            )
+        finally:
+            db.close()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,111 @@
 """
 Plugin to bury cards that look similar to current card
+
+Nothing beyond what Anki has already loaded is imported here. The rest of the
+add-on is imported the first time it's needed so it doesn't slow down
+opening a profile.
 """
 
+import sys
+from functools import partial
+
+from anki import buildinfo, hooks
 from anki.collection import _Collection as Collection
-from anki.hooks import wrap
+from anki.hooks import addHook, wrap
 from anki.sched import Scheduler
 from anki.schedv2 import Scheduler as SchedulerV2
-from anki import buildinfo
-
-from . import interface  # noqa: F401
-from . import main  # noqa: F401
+from aqt import gui_hooks, mw  # type: ignore
+from aqt.qt import QAction  # type: ignore
 
 version = tuple(map(int, buildinfo.version.split(".")))
 
+
+def _main():
+    from . import main
+
+    return main
+
+
+def buryCousins(*args, **kwargs):
+    return _main().buryCousins(*args, **kwargs)
+
+
+def buryPendingCousins(self) -> None:
+    # called for every card, so don't load main just to find nothing pending
+    main = sys.modules.get(__name__ + ".main")
+
+    if main is not None:
+        main.buryPendingCousins(self)
+
+
+def resetCousins(*args, **kwargs):
+    return _main().resetCousins(*args, **kwargs)
+
+
+def deckOpened(new_state: str, old_state: str) -> None:
+    if new_state == "overview":
+        _main().preBuryCousins(mw.col)
+
+
+def cardAnswered(reviewer, card, ease) -> None:
+    _main().buryCousinsAfterAnswer(card)
+
+
+def findDupes(*args, **kwargs):
+    return _main().findDupes(*args, **kwargs)
+
+
+def noteChanged(note) -> None:
+    # nothing to invalidate until main has been loaded
+    main = sys.modules.get(__name__ + ".main")
+
+    if main is not None:
+        main.noteChanged(note)
+
+
+def showSettings() -> None:
+    from . import interface
+
+    interface.show_settings_dialog()
+
+
+def showStats() -> None:
+    from . import interface
+
+    interface.show_stats_dialog()
+
+
 # Anki doesn't have hooks in all of the right places, so monkey patching
 # private methods is an established if fragile pattern
-Scheduler._burySiblings = wrap(Scheduler._burySiblings, main.buryCousins, "after")  # type: ignore
-SchedulerV2._burySiblings = wrap(SchedulerV2._burySiblings, main.buryCousins, "after")  # type: ignore
+Scheduler._burySiblings = wrap(Scheduler._burySiblings, buryCousins, "after")  # type: ignore
+SchedulerV2._burySiblings = wrap(SchedulerV2._burySiblings, buryCousins, "after")  # type: ignore
+Scheduler.reset = wrap(Scheduler.reset, resetCousins, "after")  # type: ignore
+SchedulerV2.reset = wrap(SchedulerV2.reset, resetCousins, "after")  # type: ignore
+Scheduler.getCard = wrap(Scheduler.getCard, buryPendingCousins, "before")  # type: ignore
+SchedulerV2.getCard = wrap(SchedulerV2.getCard, buryPendingCousins, "before")  # type: ignore
+hooks.note_will_flush.append(noteChanged)
+
+# the v3 scheduler has no _burySiblings or queues to patch
+gui_hooks.state_will_change.append(deckOpened)
+gui_hooks.reviewer_did_answer_card.append(cardAnswered)
 
 if version >= (2, 1, 45):
-    Collection.find_dupes = wrap(Collection.find_dupes, main.findDupes, None)  # type: ignore
+    Collection.find_dupes = wrap(Collection.find_dupes, findDupes, None)  # type: ignore
 else:
-    Collection.findDupes = wrap(Collection.findDupes, main.findDupes, None)  # type: ignore
+    Collection.findDupes = wrap(Collection.findDupes, findDupes, None)  # type: ignore
+
+
+# the Tools menu entry, added once however many profiles are opened
+stats_action = None
+
+
+@partial(addHook, "profileLoaded")
+def profileLoaded():
+    global stats_action
+
+    mw.addonManager.setConfigAction(__name__, showSettings)
+
+    if stats_action is None:
+        stats_action = QAction("Bury Cousins Stats", mw)
+        stats_action.triggered.connect(showStats)
+        mw.form.menuTools.addAction(stats_action)
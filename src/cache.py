@@ -0,0 +1,212 @@
+"""
+Matched note pairs kept on disk so unchanged notes aren't matched again
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Any, Callable, Iterable, List, Sequence, Set, Tuple
+
+# bump when matching changes so pairs from older versions are thrown away
+CACHE_VERSION = 2
+
+# pairs for rules that haven't been used in this long are deleted
+RULE_EXPIRY = 30 * 24 * 60 * 60
+
+MY_SIDE = 0
+COUSIN_SIDE = 1
+
+SCHEMA = """
+create table if not exists rules (
+    id integer primary key,
+    fingerprint text not null unique,
+    used integer not null
+);
+create table if not exists notes (
+    rule integer not null,
+    side integer not null,
+    nid integer not null,
+    mod integer not null,
+    primary key (rule, side, nid)
+) without rowid;
+create table if not exists pairs (
+    rule integer not null,
+    my_nid integer not null,
+    cousin_nid integer not null,
+    primary key (rule, my_nid, cousin_nid)
+) without rowid;
+create index if not exists pairs_cousin on pairs (rule, cousin_nid);
+"""
+
+NoteMods = Sequence[Tuple[int, int]]  # (note id, mod)
+Matcher = Callable[[Set[int], Set[int]], Iterable[Tuple[int, int]]]
+
+
+def fingerprint(rule: Any, *extra: Any) -> str:
+    """stable id for a rule and whatever else changes its matches
+
+    >>> from collections import namedtuple
+    >>> Rule = namedtuple("Rule", "my_field threshold")
+    >>> fingerprint(Rule("Front", 0.8), 0) == fingerprint(Rule("Front", 0.8), 0)
+    True
+    >>> fingerprint(Rule("Front", 0.8), 0) == fingerprint(Rule("Front", 0.9), 0)
+    False
+    """
+    values = [getattr(value, "name", value) for value in (*rule, *extra, CACHE_VERSION)]
+
+    return hashlib.sha1(json.dumps(values).encode()).hexdigest()
+
+
+class MatchCache:
+    """(my note id, cousin note id) pairs per rule with the note mods they saw
+
+    Every note passed to matches is remembered with its mod. On the next call,
+    only notes that were added or modified since are matched again: changed
+    notes against every cousin, then unchanged notes against changed cousins.
+    Notes missing from a call are forgotten, so all stored pairs were matched
+    with both notes present.
+
+    >>> cache = MatchCache(":memory:")
+    >>> calls = []
+    >>> def match(my_ids, cousin_ids):
+    ...     calls.append((sorted(my_ids), sorted(cousin_ids)))
+    ...     return [(a, b) for a in my_ids for b in cousin_ids if a % 10 == b % 10]
+    >>> cache.matches("rule", [(1, 0), (2, 0)], [(11, 0), (12, 0)], match)
+    [(1, 11), (2, 12)]
+    >>> calls
+    [([1, 2], [11, 12])]
+
+    only the edited cousin is matched again
+
+    >>> calls.clear()
+    >>> cache.matches("rule", [(1, 0), (2, 0)], [(11, 0), (12, 5), (21, 0)], match)
+    [(1, 11), (1, 21), (2, 12)]
+    >>> calls
+    [([1, 2], [12, 21])]
+
+    >>> calls.clear()
+    >>> cache.matches("rule", [(1, 0), (2, 0)], [(11, 0), (12, 5), (21, 0)], match)
+    [(1, 11), (1, 21), (2, 12)]
+    >>> calls
+    []
+    >>> cache.close()
+    """
+
+    def __init__(self, path: str):
+        # find duplicates runs on a background thread in newer versions of anki
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+        with self._db:
+            self._db.execute(
+                "delete from rules where used < ?", (int(time.time()) - RULE_EXPIRY,)
+            )
+            self._db.execute(
+                "delete from notes where rule not in (select id from rules)"
+            )
+            self._db.execute(
+                "delete from pairs where rule not in (select id from rules)"
+            )
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> "MatchCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def matches(
+        self,
+        fingerprint: str,
+        my_notes: NoteMods,
+        cousin_notes: NoteMods,
+        match: Matcher,
+    ) -> List[Tuple[int, int]]:
+        """every pair for the rule, calling match(my ids, cousin ids) for changes"""
+        with self._db:
+            rule = self._rule(fingerprint)
+
+            changed_my = self._update_notes(rule, MY_SIDE, my_notes)
+            changed_cousins = self._update_notes(rule, COUSIN_SIDE, cousin_notes)
+
+            self._db.execute(
+                """
+delete from pairs where rule = ? and (
+my_nid in (select nid from stale where side = ?) or
+cousin_nid in (select nid from stale where side = ?))""",
+                (rule, MY_SIDE, COUSIN_SIDE),
+            )
+            self._db.execute("delete from stale")
+
+            all_my = {note_id for note_id, _ in my_notes}
+            all_cousins = {note_id for note_id, _ in cousin_notes}
+
+            for my_ids, cousin_ids in (
+                (changed_my, all_cousins),
+                (all_my - changed_my, changed_cousins),
+            ):
+                if my_ids and cousin_ids:
+                    self._db.executemany(
+                        "insert or ignore into pairs values (?, ?, ?)",
+                        (
+                            (rule, my_id, cousin_id)
+                            for my_id, cousin_id in match(my_ids, cousin_ids)
+                        ),
+                    )
+
+            return self._db.execute(
+                "select my_nid, cousin_nid from pairs where rule = ? "
+                "order by my_nid, cousin_nid",
+                (rule,),
+            ).fetchall()
+
+    def _rule(self, fingerprint: str) -> int:
+        self._db.execute(
+            "insert or ignore into rules (fingerprint, used) values (?, 0)",
+            (fingerprint,),
+        )
+        self._db.execute(
+            "update rules set used = ? where fingerprint = ?",
+            (int(time.time()), fingerprint),
+        )
+
+        return self._db.execute(
+            "select id from rules where fingerprint = ?", (fingerprint,)
+        ).fetchone()[0]
+
+    def _update_notes(self, rule: int, side: int, notes: NoteMods) -> Set[int]:
+        """store the new mods, returning the changed note ids
+
+        Changed and forgotten notes are left in the stale table so their pairs
+        can be deleted.
+        """
+        stored = dict(
+            self._db.execute(
+                "select nid, mod from notes where rule = ? and side = ?", (rule, side)
+            )
+        )
+        current = dict(notes)
+
+        changed = {
+            note_id for note_id, mod in current.items() if stored.get(note_id) != mod
+        }
+        forgotten = stored.keys() - current.keys()
+
+        self._db.execute("create temp table if not exists stale (side, nid)")
+        self._db.executemany(
+            "insert into stale values (?, ?)",
+            ((side, note_id) for note_id in changed | forgotten),
+        )
+        self._db.executemany(
+            "delete from notes where rule = ? and side = ? and nid = ?",
+            ((rule, side, note_id) for note_id in forgotten),
+        )
+        self._db.executemany(
+            "insert or replace into notes values (?, ?, ?, ?)",
+            ((rule, side, note_id, current[note_id]) for note_id in changed),
+        )
+
+        return changed
@@ -0,0 +1,135 @@
+"""
+Compact storage for one field of many notes
+"""
+
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+
+class FieldColumn(Mapping[str, Sequence[int]]):
+    """value -> note ids for one field, with each distinct value held once
+
+    Find Duplicates on large collections used to hold every value in several
+    lists and dicts of python objects. Here note ids and mods are integer
+    arrays sorted by note id and the notes sharing a value are slices of one
+    more array. Rows can be appended as they're read, and are sorted on the
+    first lookup after.
+
+    >>> column = FieldColumn([(3, 30, "b"), (1, 10, "a"), (2, 20, "b")])
+    >>> column.distinct_values
+    ['b', 'a']
+    >>> list(column["b"])
+    [2, 3]
+    >>> column.value_of(3), column.note_mods()
+    ('b', [(1, 10), (2, 20), (3, 30)])
+    >>> list(column.rows())
+    [(1, 10, 'a'), (2, 20, 'b'), (3, 30, 'b')]
+    >>> len(column), column.note_count
+    (2, 3)
+
+    >>> column.append(0, 5, "c")
+    >>> list(column.rows())[0], list(column.values())[-1][0]
+    ((0, 5, 'c'), 0)
+    """
+
+    def __init__(self, rows: Iterable[Tuple[int, int, str]] = ()):
+        self.distinct_values: List[str] = []
+        self._value_numbers: Dict[str, int] = {}
+
+        # in the order they were appended until the next lookup sorts them
+        self._note_ids = array("q")
+        self._mods = array("q")
+        self._note_values = array("q")
+
+        # note ids grouped by value, in compressed sparse row form. None
+        # until rows stop being appended
+        self._offsets: Optional[array] = None
+        self._value_notes = array("q")
+
+        for note_id, mod, value in rows:
+            self.append(note_id, mod, value)
+
+    def append(self, note_id: int, mod: int, value: str) -> None:
+        number = self._value_numbers.get(value)
+
+        if number is None:
+            number = self._value_numbers[value] = len(self.distinct_values)
+            self.distinct_values.append(value)
+
+        self._note_ids.append(note_id)
+        self._mods.append(mod)
+        self._note_values.append(number)
+
+        self._offsets = None
+
+    def _index(self) -> array:
+        """offsets of each value's notes, sorting the rows first if needed"""
+        if self._offsets is not None:
+            return self._offsets
+
+        note_ids = self._note_ids
+        order = sorted(range(len(note_ids)), key=note_ids.__getitem__)
+
+        self._note_ids = array("q", (note_ids[i] for i in order))
+        self._mods = array("q", (self._mods[i] for i in order))
+        self._note_values = array("q", (self._note_values[i] for i in order))
+
+        counts = [0] * len(self.distinct_values)
+        for number in self._note_values:
+            counts[number] += 1
+
+        offsets = array("q", [0])
+        for count in counts:
+            offsets.append(offsets[-1] + count)
+
+        self._value_notes = array("q", bytes(8 * len(self._note_ids)))
+        filled = array("q", offsets[:-1])
+
+        for note_id, number in zip(self._note_ids, self._note_values):
+            self._value_notes[filled[number]] = note_id
+            filled[number] += 1
+
+        self._offsets = offsets
+
+        return offsets
+
+    @property
+    def note_count(self) -> int:
+        return len(self._note_ids)
+
+    def __getitem__(self, value: str) -> Sequence[int]:
+        offsets = self._index()
+        number = self._value_numbers[value]
+
+        return self._value_notes[offsets[number] : offsets[number + 1]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.distinct_values)
+
+    def __len__(self) -> int:
+        return len(self.distinct_values)
+
+    def _position(self, note_id: int) -> int:
+        self._index()
+        i = bisect_left(self._note_ids, note_id)
+
+        if i == len(self._note_ids) or self._note_ids[i] != note_id:
+            raise KeyError(note_id)
+
+        return i
+
+    def value_of(self, note_id: int) -> str:
+        return self.distinct_values[self._note_values[self._position(note_id)]]
+
+    def note_mods(self) -> List[Tuple[int, int]]:
+        """(note id, mod) by note id"""
+        self._index()
+        return list(zip(self._note_ids, self._mods))
+
+    def rows(self) -> Iterator[Tuple[int, int, str]]:
+        """(note id, mod, value) by note id"""
+        self._index()
+
+        for note_id, mod, number in zip(self._note_ids, self._mods, self._note_values):
+            yield note_id, mod, self.distinct_values[number]
@@ -0,0 +1,161 @@
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+from typing import (
+    AbstractSet,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+
+class CousinGraph:
+    """note id -> cousin note ids, stored as sorted integer arrays
+
+    Holding tens of thousands of python ints in sets takes a lot of memory, so
+    the adjacency is kept in compressed sparse row form: sorted note ids,
+    offsets into one array of cousin note ids.
+
+    >>> graph = CousinGraph([(1, 3), (1, 2), (4, 1), (1, 2)])
+    >>> list(graph.cousins(1))
+    [2, 3]
+
+    >>> list(graph.cousins(2))
+    []
+
+    >>> list(graph.without({2}).edges())
+    [(1, 3), (4, 1)]
+
+    >>> list(graph.extended([(2, 4)]).edges())
+    [(1, 2), (1, 3), (2, 4), (4, 1)]
+    """
+
+    def __init__(self, edges: Iterable[Tuple[int, int]] = ()):
+        self._notes = array("q")
+        self._offsets = array("q", [0])
+        self._cousins = array("q")
+
+        for note_id, group in groupby(sorted(set(edges)), key=lambda edge: edge[0]):
+            self._notes.append(note_id)
+            self._cousins.extend(cousin_id for _, cousin_id in group)
+            self._offsets.append(len(self._cousins))
+
+    def __len__(self) -> int:
+        return len(self._cousins)
+
+    def cousins(self, note_id: int) -> Sequence[int]:
+        i = bisect_left(self._notes, note_id)
+
+        if i == len(self._notes) or self._notes[i] != note_id:
+            return ()
+
+        return self._cousins[self._offsets[i] : self._offsets[i + 1]]
+
+    def edges(self) -> Iterator[Tuple[int, int]]:
+        for i, note_id in enumerate(self._notes):
+            for cousin_id in self._cousins[self._offsets[i] : self._offsets[i + 1]]:
+                yield note_id, cousin_id
+
+    def without(self, note_ids: AbstractSet[int]) -> "CousinGraph":
+        """copy dropping every edge that touches note_ids"""
+        return CousinGraph(
+            (note_id, cousin_id)
+            for note_id, cousin_id in self.edges()
+            if note_id not in note_ids and cousin_id not in note_ids
+        )
+
+    def extended(self, edges: Iterable[Tuple[int, int]]) -> "CousinGraph":
+        """copy with additional edges"""
+        return CousinGraph(list(self.edges()) + list(edges))
+
+
+def clusters(edges: Iterable[Tuple[int, int]]) -> List[List[int]]:
+    """note ids connected through any chain of edges, by union-find
+
+    Edges are treated as undirected, so a cousin of a cousin shares a cluster.
+
+    >>> clusters([(5, 2), (3, 4), (2, 1), (4, 3)])
+    [[1, 2, 5], [3, 4]]
+
+    >>> clusters([])
+    []
+    """
+    parents: Dict[int, int] = {}
+
+    def find(note_id: int) -> int:
+        parents.setdefault(note_id, note_id)
+
+        while parents[note_id] != note_id:
+            # path halving keeps the trees shallow
+            parents[note_id] = parents[parents[note_id]]
+            note_id = parents[note_id]
+
+        return note_id
+
+    for note_id, cousin_id in edges:
+        root, cousin_root = find(note_id), find(cousin_id)
+
+        if root != cousin_root:
+            parents[max(root, cousin_root)] = min(root, cousin_root)
+
+    groups: Dict[int, List[int]] = {}
+
+    for note_id in sorted(parents):
+        groups.setdefault(find(note_id), []).append(note_id)
+
+    return list(groups.values())
+
+
+def merge_groups(
+    groups: Iterable[Tuple[str, str, Iterable[int]]],
+) -> List[Tuple[str, List[int]]]:
+    """merge (rule, label, note ids) groups sharing any note into clusters
+
+    Each cluster is labelled with the rules that linked it and the label of
+    its biggest group.
+
+    >>> merge_groups([
+    ...     ("prefix", "abc", {1, 2}),
+    ...     ("similarity", "abd", {2, 3, 6}),
+    ...     ("prefix", "xyz", {4, 5}),
+    ... ])
+    [('[prefix, similarity] abd', [1, 2, 3, 6]), ('[prefix] xyz', [4, 5])]
+    """
+    sorted_groups = [
+        (rule, label, sorted(note_ids)) for rule, label, note_ids in groups
+    ]
+
+    edges = [
+        (note_ids[0], note_id)
+        for _, _, note_ids in sorted_groups
+        for note_id in note_ids[1:]
+    ]
+
+    cluster_of: Dict[int, int] = {}
+    members = clusters(edges)
+
+    for number, note_ids in enumerate(members):
+        for note_id in note_ids:
+            cluster_of[note_id] = number
+
+    rules: List[Set[str]] = [set() for _ in members]
+    labels: List[Tuple[int, str]] = [(0, "") for _ in members]
+
+    for rule, label, note_ids in sorted_groups:
+        if len(note_ids) < 2:
+            continue
+
+        number = cluster_of[note_ids[0]]
+        rules[number].add(rule)
+
+        if len(note_ids) > labels[number][0]:
+            labels[number] = (len(note_ids), label)
+
+    return [
+        ("[%s] %s" % (", ".join(sorted(rules[number])), label), note_ids)
+        for number, ((_, label), note_ids) in enumerate(zip(labels, members))
+    ]
@@ -0,0 +1,187 @@
+"""
+Opt-in timings and counters for each rule, to find out which one is slow
+"""
+
+import json
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# samples kept per rule, older ones are dropped
+WINDOW = 500
+
+
+class Measurement:
+    """counters filled in while a rule or call runs"""
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.candidates = 0  # notes the rule was matched against
+        self.comparisons = 0  # value pairs that could have matched
+        self.matches = 0
+        self.buried = 0  # cards
+
+
+class Recorder:
+    """rolling window of measurements per (operation, rule)
+
+    rule is None for the whole call.
+
+    >>> recorder = Recorder(enabled=True)
+    >>> for seconds in range(1, 101):
+    ...     with recorder.measure("buryCousins") as measurement:
+    ...         measurement.matches = 1
+    ...     measurement.seconds = seconds
+    >>> stats = recorder.summary()[0]
+    >>> stats["p50"], stats["p95"], stats["p99"], stats["matches"]
+    (50, 95, 99, 100)
+
+    disabled recorders don't keep anything
+
+    >>> recorder = Recorder()
+    >>> with recorder.measure("buryCousins") as measurement:
+    ...     pass
+    >>> recorder.summary()
+    []
+    """
+
+    def __init__(self, enabled: bool = False, log_path: Optional[str] = None):
+        self.enabled = enabled
+        self.log_path = log_path
+        self._samples: Dict[Tuple[str, Any], Deque[Measurement]] = defaultdict(
+            lambda: deque(maxlen=WINDOW)
+        )
+
+    @contextmanager
+    def measure(self, operation: str, rule: Any = None) -> Iterator[Measurement]:
+        measurement = Measurement()
+        start = time.perf_counter()
+
+        yield measurement
+
+        measurement.seconds = time.perf_counter() - start
+
+        if self.enabled:
+            self._samples[operation, rule].append(measurement)
+
+            if self.log_path:
+                self._log(operation, rule, measurement)
+
+    def _log(self, operation: str, rule: Any, measurement: Measurement) -> None:
+        entry = {
+            "time": time.time(),
+            "operation": operation,
+            "rule": _describe(rule),
+            **vars(measurement),
+        }
+
+        with open(self.log_path, "a") as f:  # type: ignore
+            f.write(json.dumps(entry) + "\n")
+
+    def clear(self) -> None:
+        self._samples.clear()
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """percentiles of seconds and totals of the counters per rule"""
+        summary = []
+
+        # copied first since background matching can record while this runs
+        for (operation, rule), window in list(self._samples.items()):
+            samples = list(window)
+
+            if not samples:
+                # created but not appended to yet
+                continue
+
+            seconds = sorted(sample.seconds for sample in samples)
+
+            summary.append(
+                {
+                    "operation": operation,
+                    "rule": rule,
+                    "calls": len(samples),
+                    "p50": _percentile(seconds, 50),
+                    "p95": _percentile(seconds, 95),
+                    "p99": _percentile(seconds, 99),
+                    "candidates": sum(sample.candidates for sample in samples),
+                    "comparisons": sum(sample.comparisons for sample in samples),
+                    "matches": sum(sample.matches for sample in samples),
+                    "buried": sum(sample.buried for sample in samples),
+                }
+            )
+
+        return summary
+
+
+def _percentile(ordered: Sequence[float], percent: int) -> float:
+    """nearest rank
+
+    >>> _percentile([1, 2, 3, 4], 50)
+    2
+    >>> _percentile([1, 2, 3, 4], 99)
+    4
+    """
+    rank = -(-len(ordered) * percent // 100)  # ceiling division
+    return ordered[max(rank, 1) - 1]
+
+
+def _describe(rule: Any) -> Any:
+    # MatchRule isn't json serializable because of its comparison enum
+    if rule is None:
+        return None
+
+    return {
+        field: getattr(value, "name", value) for field, value in rule._asdict().items()
+    }
+
+
+class SessionLog:
+    """queue rebuilds and answered cards appended as JSON lines
+
+    benchmarks/replay.py plays them back against a copy of the collection to
+    time each answer the way it was taken. Nothing is written without a path.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "sessions.jsonl")
+    >>> log = SessionLog(path)
+    >>> log.reset(deck_id=1, rules=[[1, "Front", 1, "Front", "prefix", 0.5]], options={})
+    >>> log.answer(card_id=10, note_id=20, queues={"rev_queue": 5, "new_queue": 0})
+    >>> [(event["event"], event.get("card")) for event in read_session_log(path)]
+    [('reset', None), ('answer', 10)]
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+
+    def reset(
+        self, deck_id: int, rules: List[List[Any]], options: Dict[str, Any]
+    ) -> None:
+        """queues rebuilt for deck_id with the rules and options in the config"""
+        self._write(
+            {"event": "reset", "deck": deck_id, "rules": rules, "options": options}
+        )
+
+    def answer(self, card_id: int, note_id: int, queues: Dict[str, int]) -> None:
+        """card answered with queues sized as they were when it was answered"""
+        self._write({"event": "answer", "card": card_id, "note": note_id, **queues})
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        if not self.path:
+            return
+
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"time": time.time(), **entry}) + "\n")
+
+
+def read_session_log(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+# shared by the review and browser code paths
+recorder = Recorder()
+
+session_log = SessionLog()
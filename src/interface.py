@@ -1,4 +1,4 @@
-from typing import List, Iterable, TYPE_CHECKING
+from typing import List, Iterable, Optional, TYPE_CHECKING
 from functools import partial
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import (
@@ -10,14 +10,19 @@ from PyQt5.QtWidgets import (
     QComboBox,
     QCheckBox,
     QDoubleSpinBox,
+    QHBoxLayout,
     QLabel,
+    QSpinBox,
+    QTableWidget,
+    QTableWidgetItem,
     QWidget,
 )
-from anki.hooks import addHook
 from anki.collection import _Collection
 from aqt import mw  # type: ignore
 
-from .settings import SettingsManager, MatchRule, Comparisons
+from .instrumentation import recorder
+from .matching import CURRENT_DECK, normalization_cache
+from .settings import SettingsManager, MatchRule, Comparisons, Options
 
 if TYPE_CHECKING:
     from anki.models import NoteType  # noqa: F401
@@ -50,6 +55,7 @@ def show_settings_dialog() -> None:
             QLabel("match field"),
             QLabel("matcher"),
             QLabel("similarity"),
+            QLabel("cousins in"),
         )
     )
 
@@ -73,8 +79,12 @@ def show_settings_dialog() -> None:
 
     append.clicked.connect(add_new_rule)
 
+    options_form = OptionsForm()
+    options_form.set_values(SettingsManager(col).load_options())
+
     dialog_layout.addLayout(form_grid)
     dialog_layout.addWidget(append)
+    dialog_layout.addLayout(options_form)
     dialog_layout.addWidget(buttons)
 
     if dialog.exec_():
@@ -85,6 +95,7 @@ def show_settings_dialog() -> None:
                 if match_form.is_valid()
             ]
         )
+        SettingsManager(col).save_options(options_form.make_options())
 
 
 class FormGrid(QGridLayout):
@@ -129,6 +140,7 @@ class MatchRuleForm:
         self._matcher = QComboBox()
         self._matcher.addItem("by prefix", Comparisons.prefix)
         self._matcher.addItem("by similarity", Comparisons.similarity)
+        self._matcher.addItem("by tf-idf similarity", Comparisons.tfidf)
         self._matcher.addItem("contains", Comparisons.contains)
         self._matcher.addItem("contained by", Comparisons.contained_by)
         self._matcher.addItem(
@@ -141,6 +153,12 @@ class MatchRuleForm:
         self._threshold.setSingleStep(0.05)
         self._threshold.setValue(0.95)
 
+        # pick a scope or type in an anki search like deck:Spanish
+        self._scope = QComboBox()
+        self._scope.setEditable(True)
+        self._scope.addItem("whole collection", "")
+        self._scope.addItem("current deck", CURRENT_DECK)
+
         self._delete = QCheckBox("delete?")
 
     @property
@@ -152,6 +170,7 @@ class MatchRuleForm:
             self._other_note_field,
             self._matcher,
             self._threshold,
+            self._scope,
             self._delete,
         ]
 
@@ -178,6 +197,14 @@ class MatchRuleForm:
         if rule.threshold:
             self._threshold.setValue(rule.threshold)
 
+        if rule.scope:
+            index = self._scope.findData(rule.scope)
+
+            if index == -1:
+                self._scope.setEditText(rule.scope)
+            else:
+                self._scope.setCurrentIndex(index)
+
     def make_rule(self) -> MatchRule:
         return MatchRule(
             int(self._my_note_type.currentData()),
@@ -186,8 +213,18 @@ class MatchRuleForm:
             self._other_note_field.currentText(),
             self._matcher.currentData(),
             self._threshold.value(),
+            self._make_scope(),
         )
 
+    def _make_scope(self) -> str:
+        text = self._scope.currentText()
+        index = self._scope.findText(text)
+
+        if index == -1:
+            return text.strip()
+
+        return self._scope.itemData(index)
+
     def is_valid(self) -> bool:
         if self._delete.isChecked():
             return False
@@ -200,9 +237,220 @@ class MatchRuleForm:
             and rule.my_field != ""
             and rule.cousin_field != ""
             and rule.threshold > 0
+            and _valid_scope(rule.scope)
+        )
+
+
+def _valid_scope(scope: str) -> bool:
+    """whether a scope is one of the choices or a search anki can run"""
+    if scope in ("", CURRENT_DECK):
+        return True
+
+    try:
+        mw.col.findCards(scope)
+    except Exception:
+        return False
+
+    return True
+
+
+class OptionsForm(QVBoxLayout):
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._precompute_cousins = QCheckBox(
+            "find all cousins when building the review queue"
+        )
+        self._precompute_cousins.setToolTip(
+            "Slower to open a deck but faster to answer each card"
+        )
+
+        self._background_matching = QCheckBox("find cousins in the background")
+        self._background_matching.setToolTip(
+            "Cousins that take too long to find are buried once they're found"
+        )
+
+        self._bury_on_open = QCheckBox("bury cousins when a deck is opened")
+        self._bury_on_open.setToolTip("Always done with the v3 scheduler")
+
+        self._find_duplicates_workers = QSpinBox()
+        self._find_duplicates_workers.setMinimum(0)
+        self._find_duplicates_workers.setMaximum(64)
+        self._find_duplicates_workers.setSpecialValueText("one per core")
+
+        workers_row = QHBoxLayout()
+        workers_row.addWidget(QLabel("processes used to find duplicates"))
+        workers_row.addWidget(self._find_duplicates_workers)
+
+        self._cluster_duplicates = QCheckBox("group linked duplicates together")
+        self._cluster_duplicates.setToolTip(
+            "Notes linked by any rule or value are listed once in Find Duplicates"
+        )
+
+        self._cache_matches = QCheckBox("remember matches between sessions")
+        self._cache_matches.setToolTip(
+            "Only notes edited since the last search or review are matched again"
+        )
+
+        self._normalization_cache_size = QSpinBox()
+        self._normalization_cache_size.setMinimum(0)
+        self._normalization_cache_size.setMaximum(10_000_000)
+        self._normalization_cache_size.setSingleStep(10_000)
+
+        cache_size_row = QHBoxLayout()
+        cache_size_row.addWidget(QLabel("field values kept in memory"))
+        cache_size_row.addWidget(self._normalization_cache_size)
+
+        self._record_timings = QCheckBox(
+            "record timings for Tools > Bury Cousins Stats"
         )
+        self._log_timings = QCheckBox("also log timings to the add-on's user_files")
+        self._record_timings.toggled.connect(self._log_timings.setEnabled)
 
+        self._record_sessions = QCheckBox(
+            "record review sessions to the add-on's user_files for replaying"
+        )
+
+        self.addWidget(self._precompute_cousins)
+        self.addWidget(self._background_matching)
+        self.addWidget(self._bury_on_open)
+        self.addLayout(workers_row)
+        self.addWidget(self._cluster_duplicates)
+        self.addWidget(self._cache_matches)
+        self.addLayout(cache_size_row)
+        self.addWidget(self._record_timings)
+        self.addWidget(self._log_timings)
+        self.addWidget(self._record_sessions)
+
+    def set_values(self, options: Options) -> None:
+        self._precompute_cousins.setChecked(options.precompute_cousins)
+        self._background_matching.setChecked(options.background_matching)
+        self._bury_on_open.setChecked(options.bury_on_open)
+        self._find_duplicates_workers.setValue(options.find_duplicates_workers)
+        self._cluster_duplicates.setChecked(options.cluster_duplicates)
+        self._cache_matches.setChecked(options.cache_matches)
+        self._normalization_cache_size.setValue(options.normalization_cache_size)
+        self._record_timings.setChecked(options.record_timings)
+        self._log_timings.setChecked(options.log_timings)
+        self._log_timings.setEnabled(options.record_timings)
+        self._record_sessions.setChecked(options.record_sessions)
+
+    def make_options(self) -> Options:
+        return Options(
+            precompute_cousins=self._precompute_cousins.isChecked(),
+            background_matching=self._background_matching.isChecked(),
+            bury_on_open=self._bury_on_open.isChecked(),
+            find_duplicates_workers=self._find_duplicates_workers.value(),
+            cluster_duplicates=self._cluster_duplicates.isChecked(),
+            cache_matches=self._cache_matches.isChecked(),
+            normalization_cache_size=self._normalization_cache_size.value(),
+            record_timings=self._record_timings.isChecked(),
+            log_timings=self._log_timings.isChecked(),
+            record_sessions=self._record_sessions.isChecked(),
+        )
+
+
+def show_stats_dialog() -> None:
+    col: _Collection = mw.col
+
+    dialog = QDialog(mw)
+    dialog.setWindowTitle("Bury Cousins Stats")
+
+    dialog_layout = QVBoxLayout()
+    dialog.setLayout(dialog_layout)
+
+    if not SettingsManager(col).load_options().record_timings:
+        dialog_layout.addWidget(
+            QLabel("Turn on recording timings in the add-on's config to collect stats")
+        )
+
+    columns = [
+        "operation",
+        "rule",
+        "calls",
+        "p50 ms",
+        "p95 ms",
+        "p99 ms",
+        "candidates",
+        "comparisons",
+        "matches",
+        "buried",
+    ]
+
+    table = QTableWidget(0, len(columns))
+    table.setHorizontalHeaderLabels(columns)
+    table.setEditTriggers(QTableWidget.NoEditTriggers)  # type: ignore
+
+    def describe(rule: Optional[MatchRule]) -> str:
+        if rule is None:
+            return "all rules"
+
+        def name(model_id: int) -> str:
+            model = col.models.get(model_id)
+            return model["name"] if model else str(model_id)
+
+        return "%s %s %s %s %s" % (
+            name(rule.my_note_model_id),
+            rule.my_field,
+            rule.comparison.name,
+            name(rule.cousin_note_model_id),
+            rule.cousin_field,
+        )
+
+    cache_stats = QLabel()
+
+    def refresh() -> None:
+        cache = normalization_cache.stats()
+        lookups = cache["hits"] + cache["misses"]
+        cache_stats.setText(
+            "Field values cached: %d of %d, %.0f%% of %d lookups hit, %d evicted"
+            % (
+                cache["size"],
+                cache["maxsize"],
+                100 * cache["hits"] / lookups if lookups else 0,
+                lookups,
+                cache["evictions"],
+            )
+        )
+
+        summary = recorder.summary()
+        table.setRowCount(len(summary))
+
+        for row, stats in enumerate(summary):
+            values = [
+                stats["operation"],
+                describe(stats["rule"]),
+                stats["calls"],
+                "%.1f" % (stats["p50"] * 1000),
+                "%.1f" % (stats["p95"] * 1000),
+                "%.1f" % (stats["p99"] * 1000),
+                stats["candidates"],
+                stats["comparisons"],
+                stats["matches"],
+                stats["buried"],
+            ]
+
+            for column, value in enumerate(values):
+                table.setItem(row, column, QTableWidgetItem(str(value)))
+
+        table.resizeColumnsToContents()
+
+    def clear() -> None:
+        recorder.clear()
+        normalization_cache.reset_stats()
+        refresh()
+
+    reset = QPushButton("Reset")
+    reset.clicked.connect(clear)
+
+    buttons = QDialogButtonBox(QDialogButtonBox.Close)  # type: ignore
+    buttons.rejected.connect(dialog.reject)
+    buttons.addButton(reset, QDialogButtonBox.ResetRole)  # type: ignore
+
+    dialog_layout.addWidget(table)
+    dialog_layout.addWidget(cache_stats)
+    dialog_layout.addWidget(buttons)
 
-@partial(addHook, "profileLoaded")
-def profileLoaded():
-    mw.addonManager.setConfigAction(__name__, show_settings_dialog)
+    refresh()
+    dialog.resize(900, 400)
+    dialog.exec_()
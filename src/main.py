@@ -1,5 +1,25 @@
+import hashlib
+import os
+import sqlite3
+import threading
 from collections import defaultdict
-from typing import TYPE_CHECKING, DefaultDict, Iterable, List, Set, Tuple, Union, Dict
+from concurrent.futures import Future, wait
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from itertools import chain
+from typing import (
+    TYPE_CHECKING,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from anki.collection import _Collection as Collection
 from anki.consts import (
@@ -11,14 +31,45 @@ from anki.consts import (
 from anki.notes import Note
 from anki.sched import Scheduler
 from anki.schedv2 import Scheduler as SchedulerV2
-from anki.utils import ids2str, intTime, splitFields, stripHTMLMedia
+from anki.utils import ids2str, intTime, splitFields
 
+from aqt import mw  # type: ignore
 from aqt.utils import tooltip  # type: ignore
 
-from .settings import SettingsManager
+from .cache import MatchCache, fingerprint
+from .columns import FieldColumn
+from .graph import CousinGraph, clusters, merge_groups
+from .instrumentation import Measurement, recorder, session_log
+from .matching import (
+    CURRENT_DECK,
+    CompiledRule,
+    MatchRule,
+    RuleSet,
+    clear_cached_indexes,
+    duplicate_groups,
+    normalization_cache,
+    normalized_field,
+)
+from .parallel import parallel_test
+from .settings import Options, SettingsManager
 
 SomeScheduler = Union[Scheduler, SchedulerV2]
 
+# survives add-on updates
+USER_FILES = os.path.join(os.path.dirname(__file__), "user_files")
+
+TIMINGS_LOG = os.path.join(USER_FILES, "timings.jsonl")
+
+SESSIONS_LOG = os.path.join(USER_FILES, "sessions.jsonl")
+
+# seconds to wait for background matching before showing the next card.
+# Cousins found later are buried when a later card is answered or shown
+BACKGROUND_WAIT = 0.2
+
+# notes read per query in Find Duplicates. Keeps memory bounded on big
+# collections while still giving sqlite decent sized queries
+EXTRACT_BATCH_SIZE = 1000
+
 if TYPE_CHECKING:
     from anki.cards import Card
 
@@ -29,64 +80,111 @@ def buryCousins(self: SomeScheduler, card: "Card") -> None:
     Same as Anki: always delete from current rehearsal and if bury new / bury
     review are set in deck options, bury until tomorrow
     """
-    # implementation mirrors anki's _burySiblings without the options
+    settings = SettingsManager(self.col)
+    options = settings.load_options()
+
+    _configure(options)
+
+    session_log.answer(
+        card.id,
+        card.nid,
+        {
+            "rev_queue": len(self._revQueue),
+            "new_queue": len(self._newQueue),
+            "rev_count": self.revCount,
+            "new_count": self.newCount,
+        },
+    )
 
-    buryNew, buryRev = _buryConfig(self, card)
+    with recorder.measure("buryCousins") as measurement:
+        # cousins of earlier cards that weren't found before this one was
+        # shown. Anything still running is left for the next card
+        measurement.buried = _buryPendingCousins(self, timeout=0)
 
-    toBury: Set[int] = set()  # note ids
+        rule_set = settings.rule_set()
+
+        if options.background_matching:
+            measurement.buried += _submitCousins(self, card, rule_set, options)
+        else:
+            toBury = _cousinsOf(self, card.note(), rule_set, options)
+            measurement.buried += _buryCousins(self, card, toBury)
+
+
+def buryPendingCousins(self: SomeScheduler) -> None:
+    """bury cousins matched in the background before the next card is shown"""
+    if not getattr(self, "_cousinsPending", None):
+        return
+
+    with recorder.measure("buryCousins") as measurement:
+        measurement.buried = _buryPendingCousins(self, timeout=BACKGROUND_WAIT)
+
+
+def _submitCousins(
+    self: SomeScheduler, card: "Card", rule_set: RuleSet, options: Options
+) -> int:
+    """start matching card's note on a background thread
 
+    Notes and their fields are read here since the database shouldn't be used
+    from other threads. Returns the number of cards buried straight away when
+    the cousins were precomputed.
+    """
     my_note = card.note()
 
-    def field_value(note, field_name) -> str:
-        model = self.col.models.get(note.mid)
-        assert model
-        field_number = self.col.models.fieldMap(model)[field_name][0]
+    precomputed = _precomputedCousins(self, my_note, rule_set, options)
 
-        return note.fields[field_number]
+    if precomputed is not None:
+        return _buryCousins(self, card, precomputed)
 
-    config = SettingsManager(self.col).load()
+    future = mw.taskman.run_in_background(
+        partial(_findCousins, my_note, rule_set, _scopedNotes(self, rule_set))
+    )
+    _pendingCousins(self).append((card, future))
 
-    for rule in config:
-        if rule.my_note_model_id != my_note.mid:
-            continue
+    return 0
 
-        potential_cousin_notes = [
-            note
-            for note in _scheduledNotes(self)
-            if rule.cousin_note_model_id == note.mid and my_note.id != note.id
-        ]
 
-        my_value = field_value(my_note, rule.my_field)
-        cousin_values = [
-            field_value(cousin_note, rule.cousin_field)
-            for cousin_note in potential_cousin_notes
-        ]
+def _pendingCousins(self: SomeScheduler) -> List[Tuple["Card", Future]]:
+    """cards answered whose cousins are still being matched, oldest first"""
+    if getattr(self, "_cousinsPending", None) is None:
+        self._cousinsPending = []  # type: ignore
 
-        matches = rule.test([my_value], cousin_values)
+    return self._cousinsPending  # type: ignore
 
-        for cousin_note in potential_cousin_notes:
-            cousin_value = field_value(cousin_note, rule.cousin_field)
 
-            if (my_value, cousin_value) in matches:
-                # not super efficient, could just look up cids all at the end
-                toBury.add(cousin_note.id)
+def _buryPendingCousins(self: SomeScheduler, timeout: float) -> int:
+    """bury cousins from the background once they're found
 
-    cousin_cards = list(_cousinCards(self, toBury))
+    Gives up after timeout seconds, leaving the rest for the next call.
+    """
+    pending = _pendingCousins(self)
 
-    count_adjustments: Dict[int, Set[int]] = {
-        QUEUE_TYPE_REV: set(),
-        QUEUE_TYPE_NEW: set(),
-    }
-    for cid, nid, queue in cousin_cards:
-        try:
-            (self._revQueue if queue == QUEUE_TYPE_REV else self._newQueue).remove(cid)
-        except ValueError:
-            # I'm not sure why things end up here but anki protects against
-            # this. It may be needed if the card is scheduled on a different
-            # deck so it doesn't appear in the current learning queue.
-            pass
-        else:
-            count_adjustments[queue].add(nid)
+    if not pending:
+        return 0
+
+    done = wait([future for _, future in pending], timeout).done
+    buried = 0
+
+    for card, future in list(pending):
+        if future in done:
+            pending.remove((card, future))
+            buried += _buryCousins(self, card, future.result())
+
+    return buried
+
+
+def _buryCousins(self: SomeScheduler, card: "Card", toBury: Set[int]) -> int:
+    """bury toBury cousins of card, returning the number of cards buried"""
+    # implementation mirrors anki's _burySiblings without the options
+
+    buryNew, buryRev = _buryConfig(self, card)
+
+    cousin_cards: Dict[int, Dict[int, int]] = {
+        QUEUE_TYPE_REV: {},
+        QUEUE_TYPE_NEW: {},
+    }  # queue: {card id: note id}
+
+    for cid, nid, queue, _ in _cousinCards(self, toBury):
+        cousin_cards[queue][cid] = nid
 
     # Decrement counts so that Anki doesn't run out of cards, which causes it
     # to rebuild queues and makes the buried cards show up again.
@@ -94,26 +192,186 @@ def buryCousins(self: SomeScheduler, card: "Card") -> None:
     # the same queue, the count (number of notes) has already been decremented
     # but if burying a sibling in a different queue, the count is not adjusted
     # which can resurrect a buried card.
-    self.revCount -= len(count_adjustments[QUEUE_TYPE_REV])
-    self.newCount -= len(count_adjustments[QUEUE_TYPE_NEW])
+    self.revCount -= len(_removeFromQueue(self._revQueue, cousin_cards[QUEUE_TYPE_REV]))
+    self.newCount -= len(_removeFromQueue(self._newQueue, cousin_cards[QUEUE_TYPE_NEW]))
+
+    card_count = sum(len(cards) for cards in cousin_cards.values())
 
-    if cousin_cards:
+    if card_count:
         tooltip(
-            "burying %d cousin card%s"
-            % (len(cousin_cards), "s" if len(cousin_cards) > 1 else "")
+            "burying %d cousin card%s" % (card_count, "s" if card_count > 1 else "")
         )
 
-    card_ids_to_bury = [
-        id
-        for id, nid, queue in cousin_cards
-        if (buryNew and queue == QUEUE_TYPE_NEW)
-        or (buryRev and queue == QUEUE_TYPE_REV)
-    ]
+    # the v1 scheduler has always used the manually buried queue
+    manual = isinstance(self, Scheduler)
 
-    if isinstance(self, Scheduler):
-        buryCards(self, card_ids_to_bury)
-    else:
-        self.buryCards(card_ids_to_bury, manual=False)
+    for queue, bury in ((QUEUE_TYPE_NEW, buryNew), (QUEUE_TYPE_REV, buryRev)):
+        if bury and cousin_cards[queue]:
+            buryCards(self, list(cousin_cards[queue]), manual=manual)
+
+    return card_count
+
+
+def _removeFromQueue(queue: List[int], cards: Dict[int, int]) -> Set[int]:
+    """remove cards from queue in place, returning the affected note ids
+
+    Cards that aren't in the queue are ignored. I'm not sure why things end
+    up here but anki protects against this. It may be needed if the card is
+    scheduled on a different deck so it doesn't appear in the current
+    learning queue.
+    """
+    if not cards:
+        return set()
+
+    kept = []
+    removed_notes = set()
+
+    for cid in queue:
+        nid = cards.get(cid)
+
+        if nid is None:
+            kept.append(cid)
+        else:
+            removed_notes.add(nid)
+
+    queue[:] = kept
+
+    return removed_notes
+
+
+def _cousinsOf(
+    self: SomeScheduler, my_note: Note, rule_set: RuleSet, options: Options
+) -> Set[int]:
+    precomputed = _precomputedCousins(self, my_note, rule_set, options)
+
+    if precomputed is not None:
+        return precomputed
+
+    # card isn't scheduled today (e.g. learning) so it wasn't precomputed
+    return _findCousins(my_note, rule_set, _scopedNotes(self, rule_set))
+
+
+def _precomputedCousins(
+    self: SomeScheduler, my_note: Note, rule_set: RuleSet, options: Options
+) -> Optional[Set[int]]:
+    if not options.precompute_cousins:
+        return None
+
+    graphs = _cousinGraphs(self, rule_set, options)
+
+    if not graphs.covers(my_note.id, my_note.mid):
+        return None
+
+    return graphs.cousins(my_note.id, my_note.mid)
+
+
+def _findCousins(
+    my_note: Note, rule_set: RuleSet, scoped_notes: Dict[str, "ScheduledNotes"]
+) -> Set[int]:
+    """note ids of my_note's cousins, safe to run on a background thread"""
+    toBury: Set[int] = set()  # note ids
+
+    for (cousin_model_id, cousin_field_number, scope), rules in rule_set.cousin_groups(
+        my_note.mid
+    ).items():
+        # rules sharing the cousin field and scope share the values pulled out
+        potential_cousins = [
+            (note_id, value)
+            for note_id, value in scoped_notes[scope].values(
+                cousin_model_id, cousin_field_number
+            )
+            if my_note.id != note_id
+        ]
+
+        cousin_values = [cousin_value for _, cousin_value in potential_cousins]
+
+        for compiled in rules:
+            with recorder.measure("buryCousins", compiled.rule) as measurement:
+                my_value = normalized_field(
+                    my_note.id,
+                    my_note.mod,
+                    compiled.my_field_number,
+                    my_note.fields[compiled.my_field_number],
+                )
+
+                matches = set(compiled.rule.test([my_value], cousin_values))
+
+                for cousin_note_id, cousin_value in potential_cousins:
+                    if (my_value, cousin_value) in matches:
+                        toBury.add(cousin_note_id)
+
+                measurement.candidates = len(potential_cousins)
+                measurement.comparisons = len(cousin_values)
+                measurement.matches = len(matches)
+
+    return toBury
+
+
+def _matchNotes(
+    rule: MatchRule,
+    my_notes: Iterable[Tuple[int, str]],
+    cousin_notes: Iterable[Tuple[int, str]],
+    workers: int = 1,
+) -> Iterator[Tuple[int, int]]:
+    """(my note id, cousin note id) for every (note id, value) pair matched"""
+    my_mapping: DefaultDict[str, List[int]] = defaultdict(list)
+    cousin_mapping: DefaultDict[str, List[int]] = defaultdict(list)
+
+    for note_id, value in my_notes:
+        my_mapping[value].append(note_id)
+
+    for note_id, value in cousin_notes:
+        cousin_mapping[value].append(note_id)
+
+    if not my_mapping or not cousin_mapping:
+        return
+
+    for my_value, cousin_value in parallel_test(
+        rule, list(my_mapping), list(cousin_mapping), workers
+    ):
+        for my_note_id in my_mapping[my_value]:
+            for cousin_note_id in cousin_mapping[cousin_value]:
+                if my_note_id != cousin_note_id:
+                    yield my_note_id, cousin_note_id
+
+
+def _configure(options: Options) -> None:
+    normalization_cache.resize(options.normalization_cache_size)
+
+    recorder.enabled = options.record_timings
+    recorder.log_path = None
+
+    if options.record_timings and options.log_timings:
+        os.makedirs(os.path.dirname(TIMINGS_LOG), exist_ok=True)
+        recorder.log_path = TIMINGS_LOG
+
+    session_log.path = None
+
+    if options.record_sessions:
+        os.makedirs(os.path.dirname(SESSIONS_LOG), exist_ok=True)
+        session_log.path = SESSIONS_LOG
+
+
+@contextmanager
+def _matchCache(col: Collection, options: Options) -> Iterator[Optional[MatchCache]]:
+    """the collection's match cache, or None when it's off or can't be opened"""
+    if not options.cache_matches:
+        yield None
+        return
+
+    # user_files is shared by every profile
+    name = hashlib.sha1(col.path.encode()).hexdigest()[:12]
+
+    try:
+        os.makedirs(USER_FILES, exist_ok=True)
+        cache = MatchCache(os.path.join(USER_FILES, f"matches-{name}.sqlite"))
+    except (OSError, sqlite3.Error):
+        # matching still works without the cache, just slower
+        yield None
+        return
+
+    with cache:
+        yield cache
 
 
 def _buryConfig(self: SomeScheduler, card: "Card"):
@@ -134,7 +392,8 @@ def _buryConfig(self: SomeScheduler, card: "Card"):
 def buryCards(self, cids: List[int], manual: bool = True) -> None:
     # copied from SchedulerV2.buryCards. Scheduler implements a buryCards, but
     # it does a bit more than SchedulerV2 which makes the cards repeat for some
-    # reason
+    # reason. Also used for SchedulerV2 so that burying is a single statement
+    # in every version of Anki
     queue = manual and QUEUE_TYPE_MANUALLY_BURIED or QUEUE_TYPE_SIBLING_BURIED
     self.col.log(cids)
     self.col.db.execute(
@@ -147,31 +406,600 @@ def buryCards(self, cids: List[int], manual: bool = True) -> None:
     )
 
 
-def _scheduledNotes(self: SomeScheduler) -> Iterable[Note]:
-    assert self.col.db  # optional in typing system but set by this point
+class ScheduledNote(NamedTuple):
+    id: int
+    mid: int
+    mod: int
+    fields: List[str]
+
+
+class ScheduledNotes:
+    """snapshot of the notes with cards due in the current review session
+
+    Loading and splitting every due note on every answer is slow on large
+    collections. The snapshot is reused until the queues are rebuilt, the day
+    rolls over or a note is edited.
+    """
+
+    # bumped whenever a note is saved so that every snapshot goes stale
+    generation = 0
+
+    def __init__(self, col: Collection, today: int, card_filters: Iterable[str] = ()):
+        """card_filters are sql conditions on cards, like from _scopeFilter"""
+        assert col.db  # optional in typing system but set by this point
+
+        self.today = today
+        self.generation = ScheduledNotes.generation
+        self._by_model: DefaultDict[int, List[ScheduledNote]] = defaultdict(list)
+        self._values: Dict[Tuple[int, int], List[Tuple[int, str]]] = {}
+        self._note_ids: Optional[Set[int]] = None
+
+        # on did or id so sqlite narrows the cards down by index first
+        filters = "".join(f"{card_filter} and " for card_filter in card_filters)
+
+        for nid, mid, mod, flds in col.db.execute(
+            f"""
+select id, mid, mod, flds from notes where id in (
+select nid from cards where {filters}
+(queue={QUEUE_TYPE_NEW} or (queue={QUEUE_TYPE_REV} and due<=?)))""",
+            today,
+        ):
+            self._by_model[mid].append(ScheduledNote(nid, mid, mod, splitFields(flds)))
+
+    def is_current(self, today: int) -> bool:
+        return self.today == today and self.generation == ScheduledNotes.generation
+
+    def by_model(self, model_id: int) -> List[ScheduledNote]:
+        return self._by_model.get(model_id, [])
+
+    def values(self, model_id: int, field_number: int) -> List[Tuple[int, str]]:
+        """(note id, value without html) of one field, kept with the snapshot"""
+        key = (model_id, field_number)
+
+        if key not in self._values:
+            self._values[key] = [
+                (
+                    note.id,
+                    normalized_field(
+                        note.id, note.mod, field_number, note.fields[field_number]
+                    ),
+                )
+                for note in self.by_model(model_id)
+            ]
+
+        return self._values[key]
+
+    def __iter__(self) -> Iterator[ScheduledNote]:
+        return chain.from_iterable(self._by_model.values())
+
+    def __contains__(self, note_id: int) -> bool:
+        if self._note_ids is None:
+            self._note_ids = {note.id for note in self}
+
+        return note_id in self._note_ids
+
+
+def _scopeFilter(col: Collection, scope: str) -> Optional[str]:
+    """sql condition on cards for a rule's scope, None for the whole collection"""
+    if not scope:
+        return None
+
+    if scope == CURRENT_DECK:
+        # the deck being studied and its children
+        return f"did in {ids2str(col.decks.active())}"
+
+    try:
+        card_ids = col.findCards(scope)
+    except Exception:
+        # saved before searches were checked, or no longer valid in this anki
+        col.log("invalid cousin scope %r, using the whole collection" % scope)
+        return None
+
+    # searches are run once per snapshot and narrowed down by card id
+    return f"id in {ids2str(card_ids)}"
+
+
+def _scheduledNotes(self: SomeScheduler, scope: str = "") -> ScheduledNotes:
+    snapshots = getattr(self, "_cousinScheduledNotes", None) or {}
+
+    # the current deck scope follows the deck that's selected
+    key = (scope, self.col.decks.selected() if scope == CURRENT_DECK else None)
+    snapshot = snapshots.get(key)
+
+    if snapshot is None or not snapshot.is_current(self.today):
+        scope_filter = _scopeFilter(self.col, scope)
+        snapshot = ScheduledNotes(
+            self.col, self.today, [scope_filter] if scope_filter else []
+        )
+        snapshots[key] = snapshot
+        self._cousinScheduledNotes = snapshots  # type: ignore
+
+    return snapshot
+
+
+def _scopedNotes(self: SomeScheduler, rule_set: RuleSet) -> Dict[str, ScheduledNotes]:
+    """snapshot for each scope used by the rules"""
+    return {scope: _scheduledNotes(self, scope) for scope in rule_set.scopes}
+
+
+class CousinGraphs:
+    """cousins of every scheduled note, computed for all rules up front
+
+    On day rollover or after edits, only notes that were added or modified
+    since the last build are matched again. Each rule matches the notes in its
+    scope, so notes entering or leaving a scope count as changed.
+    """
+
+    def __init__(self) -> None:
+        self.scoped_notes: Dict[str, ScheduledNotes] = {}
+        self.graphs: Dict[MatchRule, CousinGraph] = {}
+        # scope: {note id: mod when last matched}
+        self.mods: Dict[str, Dict[int, int]] = {}
+
+    def covers(self, note_id: int, model_id: int) -> bool:
+        """whether every rule for model_id has matched note_id"""
+        scopes = {
+            rule.scope for rule in self.graphs if rule.my_note_model_id == model_id
+        }
+
+        return bool(scopes) and all(note_id in self.mods[scope] for scope in scopes)
+
+    def cousins(self, note_id: int, model_id: int) -> Set[int]:
+        return {
+            cousin_id
+            for rule, graph in self.graphs.items()
+            if rule.my_note_model_id == model_id
+            for cousin_id in graph.cousins(note_id)
+        }
+
+    def is_current(
+        self, rule_set: RuleSet, scoped_notes: Dict[str, ScheduledNotes]
+    ) -> bool:
+        rules = {compiled.rule for compiled in rule_set.rules}
+
+        return rules == set(self.graphs) and all(
+            snapshot is self.scoped_notes.get(scope)
+            for scope, snapshot in scoped_notes.items()
+        )
+
+    def update(
+        self,
+        rule_set: RuleSet,
+        scoped_notes: Dict[str, ScheduledNotes],
+        cache: Optional[MatchCache] = None,
+    ) -> None:
+        if self.is_current(rule_set, scoped_notes):
+            return
+
+        mods = {
+            scope: {note.id: note.mod for note in scheduled_notes}
+            for scope, scheduled_notes in scoped_notes.items()
+        }
+
+        graphs = {}
+
+        for compiled in rule_set.rules:
+            rule = compiled.rule
+            scheduled_notes = scoped_notes[rule.scope]
+            scope_mods = mods[rule.scope]
+            last_mods = self.mods.get(rule.scope, {})
+
+            changed = {
+                note_id
+                for note_id, mod in scope_mods.items()
+                if last_mods.get(note_id) != mod
+            }
+            stale = changed | (last_mods.keys() - scope_mods.keys())
+
+            my_notes = scheduled_notes.values(
+                rule.my_note_model_id, compiled.my_field_number
+            )
+            cousin_notes = scheduled_notes.values(
+                rule.cousin_note_model_id, compiled.cousin_field_number
+            )
+
+            graph = self.graphs.get(rule)
+
+            if stale and not rule.incremental:
+                # its matches depend on every cousin, so they're all redone
+                graph = None
+
+            with recorder.measure("precompute", rule) as measurement:
+                if cache is not None and rule.incremental and (graph is None or stale):
+                    graph, measurement.comparisons = _cachedGraph(
+                        cache, compiled, scheduled_notes, my_notes, cousin_notes
+                    )
+                elif graph is None:
+                    graph = CousinGraph(_matchNotes(rule, my_notes, cousin_notes))
+                    measurement.comparisons = len(my_notes) * len(cousin_notes)
+                elif stale:
+                    # changed notes against everything, then unchanged notes
+                    # against changed notes
+                    graph = graph.without(stale).extended(
+                        chain(
+                            _matchNotes(
+                                rule,
+                                [note for note in my_notes if note[0] in changed],
+                                cousin_notes,
+                            ),
+                            _matchNotes(
+                                rule,
+                                [note for note in my_notes if note[0] not in changed],
+                                [note for note in cousin_notes if note[0] in changed],
+                            ),
+                        )
+                    )
+                    measurement.comparisons = len(changed) * len(cousin_notes)
+
+                measurement.candidates = len(cousin_notes)
+                measurement.matches = len(graph)
+
+            graphs[rule] = graph
+
+        self.scoped_notes = scoped_notes
+        self.graphs = graphs
+        self.mods = mods
+
+
+def _cachedGraph(
+    cache: MatchCache,
+    compiled: CompiledRule,
+    scheduled_notes: ScheduledNotes,
+    my_notes: List[Tuple[int, str]],
+    cousin_notes: List[Tuple[int, str]],
+) -> Tuple[CousinGraph, int]:
+    """graph for the rule matching only notes changed since the cache saw them
+
+    Also returns the number of comparisons made.
+    """
+    rule = compiled.rule
+    comparisons = 0
+
+    def match(my_ids: Set[int], cousin_ids: Set[int]) -> List[Tuple[int, int]]:
+        nonlocal comparisons
+        comparisons += len(my_ids) * len(cousin_ids)
+
+        return list(
+            _matchNotes(
+                rule,
+                [note for note in my_notes if note[0] in my_ids],
+                [note for note in cousin_notes if note[0] in cousin_ids],
+            )
+        )
+
+    def mods(model_id: int) -> List[Tuple[int, int]]:
+        return [(note.id, note.mod) for note in scheduled_notes.by_model(model_id)]
+
+    pairs = cache.matches(
+        fingerprint(
+            rule, "review", compiled.my_field_number, compiled.cousin_field_number
+        ),
+        mods(rule.my_note_model_id),
+        mods(rule.cousin_note_model_id),
+        match,
+    )
+
+    return CousinGraph(pairs), comparisons
+
 
-    for (nid,) in self.col.db.execute(
+def _cousinGraphs(
+    self: SomeScheduler, rule_set: RuleSet, options: Options
+) -> CousinGraphs:
+    graphs = getattr(self, "_cousinGraphs", None)
+
+    if graphs is None:
+        graphs = self._cousinGraphs = CousinGraphs()  # type: ignore
+
+    scoped_notes = _scopedNotes(self, rule_set)
+
+    if not graphs.is_current(rule_set, scoped_notes):
+        with _matchCache(self.col, options) as cache:
+            graphs.update(rule_set, scoped_notes, cache)
+
+    return graphs
+
+
+def resetCousins(self: SomeScheduler) -> None:
+    """drop the snapshot once the scheduler rebuilds its queues
+
+    When cousins are precomputed, this is also when they get matched so that
+    answering cards stays fast.
+    """
+    self._cousinScheduledNotes = None  # type: ignore
+
+    settings = SettingsManager(self.col)
+    options = settings.load_options()
+
+    _configure(options)
+
+    if options.record_sessions:
+        session_log.reset(self.col.decks.selected(), settings.dump(), options._asdict())
+
+    if options.precompute_cousins:
+        _cousinGraphs(self, settings.rule_set(), options)
+
+
+def preBuryCousins(col: Collection) -> None:
+    """bury all but one note of each cluster of cousins due in the opened deck
+
+    The v3 scheduler builds its queues in the backend so cards can't be taken
+    out of them on each answer. Instead, the rules are matched against every
+    card due in the deck when it's opened and the cousins are buried at once.
+    """
+    settings = SettingsManager(col)
+    options = settings.load_options()
+
+    if not (options.bury_on_open or _isV3(col)):
+        return
+
+    today = col.sched.today
+    deck_ids = sorted(col.decks.active())
+    done = (today, deck_ids, ScheduledNotes.generation)
+
+    # the overview is shown again after every review session
+    if getattr(col, "_cousinPreBuried", None) == done:
+        return
+
+    _configure(options)
+
+    with recorder.measure("preBury") as measurement:
+        measurement.buried = _preBuryCousins(
+            col, settings.rule_set(), options, today, deck_ids
+        )
+
+    col._cousinPreBuried = done  # type: ignore
+
+
+def _preBuryCousins(
+    col: Collection,
+    rule_set: RuleSet,
+    options: Options,
+    today: int,
+    deck_ids: List[int],
+) -> int:
+    """bury cousins due in deck_ids, returning the number of cards buried"""
+    assert col.db  # optional in typing system but set by this point
+
+    graphs = CousinGraphs()
+    in_decks = f"did in {ids2str(deck_ids)}"
+    scoped_notes = {}
+
+    for scope in rule_set.scopes:
+        scope_filter = _scopeFilter(col, scope)
+        scoped_notes[scope] = ScheduledNotes(
+            col, today, [in_decks, scope_filter] if scope_filter else [in_decks]
+        )
+
+    with _matchCache(col, options) as cache:
+        graphs.update(rule_set, scoped_notes, cache)
+
+    # the note kept from each cluster is the one that would probably be shown
+    # first: reviews before new cards, then by due
+    first: Dict[int, Tuple[bool, int]] = {}  # note id: (not review, due)
+    cards: DefaultDict[int, List[Tuple[int, int, int]]] = defaultdict(list)
+
+    for cid, nid, did, queue, due in col.db.execute(
         f"""
-select distinct(nid) from cards where
+select id, nid, did, queue, due from cards where {in_decks} and
 (queue={QUEUE_TYPE_NEW} or (queue={QUEUE_TYPE_REV} and due<=?))""",
-        self.today,
+        today,
     ):
-        yield Note(self.col, id=nid)
+        order = (queue != QUEUE_TYPE_REV, due)
+        first[nid] = min(first.get(nid, order), order)
+        cards[nid].append((cid, did, queue))
+
+    bury_config = lru_cache(maxsize=None)(partial(_deckBuryConfig, col))
+    edges = chain.from_iterable(graph.edges() for graph in graphs.graphs.values())
+
+    toBury = []
+
+    for cluster in clusters(edges):
+        keep = min(cluster, key=lambda nid: (first[nid], nid))
+
+        for nid in cluster:
+            if nid == keep:
+                continue
+
+            for cid, did, queue in cards[nid]:
+                buryNew, buryRev = bury_config(did)
+
+                if buryRev if queue == QUEUE_TYPE_REV else buryNew:
+                    toBury.append(cid)
+
+    if toBury:
+        _bulkBury(col, toBury)
+        tooltip(
+            "buried %d cousin card%s" % (len(toBury), "s" if len(toBury) > 1 else "")
+        )
+
+    return len(toBury)
+
+
+def buryCousinsAfterAnswer(card: "Card") -> None:
+    """bury cousins of an answered card with the v3 scheduler
+
+    Catches cousins that weren't due when the deck was opened, like learning
+    cards that have graduated since. Other schedulers bury cousins along with
+    siblings instead.
+    """
+    col = card.col
+
+    if not _isV3(col):
+        return
+
+    settings = SettingsManager(col)
+    options = settings.load_options()
+
+    _configure(options)
+
+    with recorder.measure("buryCousins") as measurement:
+        toBury = _cousinsOf(col.sched, card.note(), settings.rule_set(), options)
+
+        bury_config = lru_cache(maxsize=None)(partial(_deckBuryConfig, col))
+        cids = []
+
+        for cid, _, queue, did in _cousinCards(col.sched, toBury):
+            buryNew, buryRev = bury_config(did)
+
+            if buryRev if queue == QUEUE_TYPE_REV else buryNew:
+                cids.append(cid)
+
+        if cids:
+            _bulkBury(col, cids)
+
+        measurement.buried = len(cids)
+
+
+def _isV3(col: Collection) -> bool:
+    # only in Anki>=2.1.45
+    v3_scheduler = getattr(col, "v3_scheduler", None)
+
+    return v3_scheduler is not None and v3_scheduler()
+
+
+def _deckBuryConfig(col: Collection, deck_id: int) -> Tuple[bool, bool]:
+    """(bury new, bury reviews) from the deck's options"""
+    # filtered decks have no new or rev options
+    conf = col.decks.confForDid(deck_id)
+
+    return (
+        conf.get("new", {}).get("bury", True),
+        conf.get("rev", {}).get("bury", True),
+    )
+
+
+def _bulkBury(col: Collection, cids: List[int]) -> None:
+    if _isV3(col):
+        # also makes the backend rebuild its queues
+        col.sched.bury_cards(cids, manual=False)
+    else:
+        # the queues are rebuilt when the overview refreshes
+        buryCards(col.sched, cids, manual=isinstance(col.sched, Scheduler))
+
+
+def noteChanged(note: Note) -> None:
+    ScheduledNotes.generation += 1
 
 
 def _cousinCards(
     self: SomeScheduler, note_ids: Set[int]
-) -> Iterable[Tuple[int, int, int]]:
+) -> Iterable[Tuple[int, int, int, int]]:
+    """(card id, note id, queue, deck id) of the due cards of note_ids"""
     assert self.col.db  # optional in typing system but set by this point
 
     return self.col.db.execute(
         f"""
-    select id, nid, queue from cards where nid in {ids2str(list(note_ids))}
+    select id, nid, queue, did from cards where nid in {ids2str(list(note_ids))}
     and (queue={QUEUE_TYPE_NEW} or (queue={QUEUE_TYPE_REV} and due<=?))""",
         self.today,
     )  # type: ignore
 
 
+class FindDupesProgress:
+    """progress bar updates and cancellation for Find Duplicates
+
+    Newer versions of Anki search for duplicates on a background thread so
+    updates are handed to the main thread.
+    """
+
+    def __init__(self, rule_count: int):
+        self.rule_count = rule_count
+        self.rule_number = 0
+
+    def update(self, done: int, total: int) -> None:
+        label = "Finding cousins for rule %d of %d" % (
+            self.rule_number,
+            self.rule_count,
+        )
+
+        def update() -> None:
+            mw.progress.update(label=label, value=done, max=total)
+
+        if threading.current_thread() is threading.main_thread():
+            update()
+        else:
+            mw.taskman.run_on_main(update)
+
+    def check_cancelled(self) -> None:
+        # only available in newer versions of Anki
+        want_cancel = getattr(mw.progress, "want_cancel", None)
+
+        if want_cancel is not None and want_cancel():
+            raise FindDupesCancelled()
+
+
+class FindDupesCancelled(Exception):
+    pass
+
+
+class FindDupesColumns:
+    """every field the rules need, read with one scan per note type and scope
+
+    Rules sharing a note type used to search for its notes and split their
+    fields once each. Here all of the note type's fields used by any rule are
+    pulled out the first time one of them is needed.
+    """
+
+    def __init__(
+        self,
+        col: Collection,
+        rules: Iterable[MatchRule],
+        search: str,
+        progress: FindDupesProgress,
+    ):
+        self.col = col
+        self.search_filters = [f"({search})"] if search else []
+        self.progress = progress
+
+        # (model id, scope): field names
+        self.planned: DefaultDict[Tuple[int, str], Set[str]] = defaultdict(set)
+        self.columns: Dict[Tuple[int, str], Dict[str, Tuple[int, FieldColumn]]] = {}
+
+        for rule in rules:
+            self.planned[(rule.my_note_model_id, "")].add(rule.my_field)
+            self.planned[(rule.cousin_note_model_id, rule.scope)].add(rule.cousin_field)
+
+    def column(
+        self, model_id: int, field_name: str, scope: str = ""
+    ) -> Tuple[int, FieldColumn]:
+        """field ord and the field of each note in scope"""
+        key = (model_id, scope)
+
+        if key not in self.columns:
+            self.columns[key] = self._extract(model_id, scope, self.planned[key])
+
+        return self.columns[key][field_name]
+
+    def _extract(
+        self, model_id: int, scope: str, field_names: Set[str]
+    ) -> Dict[str, Tuple[int, FieldColumn]]:
+        # type works better in future anki
+        model = self.col.models.get(model_id)
+        assert model  # type is optional, but None should never come back
+
+        note_ids = self.col.findNotes(
+            " ".join(
+                self.search_filters + _scopeSearch(scope) + [f'note:{model["name"]}']
+            )
+        )
+
+        field_ords: Dict[str, int] = {
+            field_name: next(
+                field["ord"] for field in model["flds"] if field["name"] == field_name
+            )
+            for field_name in field_names
+        }
+
+        columns = _extractFields(
+            self.col, note_ids, set(field_ords.values()), self.progress
+        )
+
+        return {
+            field_name: (field_ord, columns[field_ord])
+            for field_name, field_ord in field_ords.items()
+        }
+
+
 def findDupes(
     self: Collection, fieldName: str, search: str = "", *, _old
 ) -> List[Tuple[str, List[int]]]:
@@ -182,87 +1010,199 @@ def findDupes(
         for value, note_ids in _old(self, fieldName, search)
     ]
 
-    config = SettingsManager(self).load()
+    options = SettingsManager(self).load_options()
 
-    search_filters = []
+    _configure(options)
 
-    if search:
-        search_filters.append(f"({search})")
+    with recorder.measure("findDupes") as measurement:
+        try:
+            cousin_matches = _findDupes(self, fieldName, search, options)
+        finally:
+            clear_cached_indexes()
 
-    def extract_field(model_id, field_name) -> Iterable[Tuple[int, str]]:
-        # type works better in future anki
-        model = self.models.get(model_id)
-        assert model  # type is optional, but None should never come back
+        measurement.matches = len(cousin_matches)
 
-        note_ids = self.findNotes(" ".join(search_filters + [f'note:{model["name"]}']))
+    if options.cluster_duplicates:
+        return _clusterDuplicates(exact_duplicates + cousin_matches)
 
-        field_ord: int = next(
-            field["ord"] for field in model["flds"] if field["name"] == field_name
-        )
+    return exact_duplicates + cousin_matches
 
-        assert self.db
 
-        for note_id, fields in self.db.all(
-            "select id, flds from notes where id in " + ids2str(note_ids)
-        ):
-            value = splitFields(fields)[field_ord]
-            yield note_id, stripHTMLMedia(value)
+def _clusterDuplicates(
+    duplicates: List[Tuple[str, List[int]]],
+) -> List[Tuple[str, List[int]]]:
+    """one group for each set of notes linked by any rule or value"""
+    groups = []
 
-    duplicate_groups: DefaultDict[str, Set[int]] = defaultdict(set)
+    for key, note_ids in duplicates:
+        # keys look like "[rule] value"
+        rule, _, value = key[1:].partition("] ")
+        groups.append((rule, value, note_ids))
 
-    for rule in config:
-        # only use rules based off the selected field
-        if rule.my_field != fieldName:
-            continue
+    return merge_groups(groups)
 
-        my_note_fields = list(extract_field(rule.my_note_model_id, rule.my_field))
-        my_values = [f[1] for f in my_note_fields]
 
-        same_field = (
-            rule.cousin_note_model_id == rule.my_note_model_id
-            and rule.cousin_field == rule.my_field
-        )
+def _findDupes(
+    self: Collection, fieldName: str, search: str, options: Options
+) -> List[Tuple[str, List[int]]]:
+    # only use rules based off the selected field
+    config = [
+        rule for rule in SettingsManager(self).load() if rule.my_field == fieldName
+    ]
+    workers = options.find_duplicates_workers
 
-        if same_field:
-            cousin_note_fields = my_note_fields
-            cousin_values = my_values
-        else:
-            cousin_note_fields = list(
-                extract_field(rule.cousin_note_model_id, rule.cousin_field)
+    progress = FindDupesProgress(len(config))
+
+    columns = FindDupesColumns(self, config, search, progress)
+
+    groups: DefaultDict[str, Set[int]] = defaultdict(set)
+
+    with _matchCache(self, options) as cache:
+        try:
+            for rule in config:
+                progress.rule_number += 1
+
+                with recorder.measure("findDupes", rule) as measurement:
+                    my_ord, my_column = columns.column(
+                        rule.my_note_model_id, rule.my_field
+                    )
+                    cousin_ord, cousin_column = columns.column(
+                        rule.cousin_note_model_id, rule.cousin_field, rule.scope
+                    )
+
+                    measurement.candidates = cousin_column.note_count
+
+                    if cache is None or not rule.incremental:
+                        rule_groups = _ruleDuplicates(
+                            rule, my_column, cousin_column, workers, measurement
+                        )
+                    else:
+                        rule_groups = _cachedRuleDuplicates(
+                            cache,
+                            fingerprint(rule, "findDupes", my_ord, cousin_ord),
+                            rule,
+                            my_column,
+                            cousin_column,
+                            workers,
+                            measurement,
+                        )
+
+                progress.check_cancelled()
+
+                for key, note_ids in rule_groups.items():
+                    groups[key].update(note_ids)
+        except FindDupesCancelled:
+            # show what was found before the search was cancelled
+            pass
+
+    return [(key, list(note_ids)) for key, note_ids in groups.items()]
+
+
+def _scopeSearch(scope: str) -> List[str]:
+    """anki search terms for a rule's scope"""
+    if not scope:
+        return []
+
+    if scope == CURRENT_DECK:
+        return ["deck:current"]
+
+    return [f"({scope})"]
+
+
+def _ruleDuplicates(
+    rule: MatchRule,
+    my_column: FieldColumn,
+    cousin_column: FieldColumn,
+    workers: int,
+    measurement: Measurement,
+) -> Dict[str, Set[int]]:
+    matches = parallel_test(
+        rule, my_column.distinct_values, cousin_column.distinct_values, workers
+    )
+
+    measurement.comparisons = len(my_column) * len(cousin_column)
+    measurement.matches = len(matches)
+
+    return duplicate_groups(rule, matches, my_column, cousin_column)
+
+
+def _cachedRuleDuplicates(
+    cache: MatchCache,
+    key: str,
+    rule: MatchRule,
+    my_column: FieldColumn,
+    cousin_column: FieldColumn,
+    workers: int,
+    measurement: Measurement,
+) -> Dict[str, Set[int]]:
+    """same groups as _ruleDuplicates, only matching notes that changed"""
+
+    def match(my_ids: Set[int], cousin_ids: Set[int]) -> List[Tuple[int, int]]:
+        measurement.comparisons += len(my_ids) * len(cousin_ids)
+
+        return list(
+            _matchNotes(
+                rule,
+                [
+                    (note_id, value)
+                    for note_id, _, value in my_column.rows()
+                    if note_id in my_ids
+                ],
+                [
+                    (note_id, value)
+                    for note_id, _, value in cousin_column.rows()
+                    if note_id in cousin_ids
+                ],
+                workers,
             )
-            cousin_values = [f[1] for f in cousin_note_fields]
+        )
 
-        matches = rule.test(my_values, cousin_values)
+    pairs = cache.matches(
+        key,
+        my_column.note_mods(),
+        cousin_column.note_mods(),
+        match,
+    )
 
-        if not matches:
-            continue
+    groups: DefaultDict[str, Set[int]] = defaultdict(set)
 
-        my_mapping = defaultdict(list)
+    for my_note_id, cousin_note_id in pairs:
+        group = f"[{rule.comparison.name}] {my_column.value_of(my_note_id)}"
+        groups[group].update((my_note_id, cousin_note_id))
 
-        for my_note_id, my_note_field in my_note_fields:
-            my_mapping[my_note_field].append(my_note_id)
+    measurement.matches = len(pairs)
 
-        if same_field:
-            cousin_mapping = my_mapping
-        else:
-            cousin_mapping = defaultdict(list)
+    return dict(groups)
 
-            for cousin_note_id, cousin_note_field in cousin_note_fields:
-                cousin_mapping[cousin_note_field].append(cousin_note_id)
 
-        for my_value, cousin_value in matches:
-            for my_note_id in my_mapping[my_value]:
-                key = f"[{rule.comparison.name}] {my_value}"
+def _extractFields(
+    col: Collection,
+    note_ids: List[int],
+    field_ords: Set[int],
+    progress: FindDupesProgress,
+) -> Dict[int, FieldColumn]:
+    """field ord: column of each note's value without html
 
-                for cousin_note_id in cousin_mapping[cousin_value]:
-                    if my_note_id == cousin_note_id:
-                        continue
+    Notes are read in batches and each one is only split once, straight into
+    the columns.
+    """
+    assert col.db
 
-                    duplicate_groups[key].add(my_note_id)
-                    duplicate_groups[key].add(cousin_note_id)
+    columns = {field_ord: FieldColumn() for field_ord in field_ords}
 
-    cousin_matches = [
-        (key, list(note_ids)) for key, note_ids in duplicate_groups.items()
-    ]
+    for start in range(0, len(note_ids), EXTRACT_BATCH_SIZE):
+        batch = note_ids[start : start + EXTRACT_BATCH_SIZE]
 
-    return exact_duplicates + cousin_matches
+        for note_id, mod, fields in col.db.execute(
+            "select id, mod, flds from notes where id in " + ids2str(batch)
+        ):
+            values = splitFields(fields)
+
+            for field_ord, column in columns.items():
+                value = normalized_field(note_id, mod, field_ord, values[field_ord])
+                column.append(note_id, mod, value)
+
+        progress.update(start + len(batch), len(note_ids))
+        progress.check_cancelled()
+
+    return columns
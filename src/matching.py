@@ -0,0 +1,1170 @@
+"""
+Rules and the engines that match field values, usable without Anki or Qt
+"""
+
+import difflib
+import enum
+import html
+import math
+import os
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict, deque
+from functools import lru_cache
+from itertools import chain, product
+from os.path import commonprefix
+from typing import (
+    Any,
+    Callable,
+    DefaultDict,
+    Dict,
+    FrozenSet,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+CLOZE_EXTRACT = re.compile(r"{{(?P<group>.*?)::(?P<answer>.*?)(::.*?)?}}")
+
+# runs of word characters, the same ones \b looks for
+WORD = re.compile(r"\w+")
+
+# same as anki's stripHTMLMedia
+HTML_COMMENT = re.compile(r"(?s)<!--.*?-->")
+HTML_STYLE = re.compile(r"(?si)<style.*?>.*?</style>")
+HTML_SCRIPT = re.compile(r"(?si)<script.*?>.*?</script>")
+HTML_TAG = re.compile(r"(?s)<.*?>")
+HTML_MEDIA = re.compile(r"(?i)<img[^>]+src=[\"']?([^\"'>]+)[\"']?[^>]*>")
+
+# normalized values kept by default, see NormalizationCache
+DEFAULT_CACHE_SIZE = 100_000
+
+
+def strip_html(text: str) -> str:
+    """text without html, with images replaced by their file names
+
+    Fields are stripped the same way while reviewing and in Find Duplicates.
+
+    >>> strip_html('<b>a&nbsp;b</b><img src="cat.jpg"><!-- note -->&amp; c')
+    'a b cat.jpg & c'
+    """
+    text = HTML_MEDIA.sub(r" \1 ", text)
+
+    for pattern in (HTML_COMMENT, HTML_STYLE, HTML_SCRIPT, HTML_TAG):
+        text = pattern.sub("", text)
+
+    return html.unescape(text.replace("&nbsp;", " "))
+
+
+class NormalizationCache:
+    """least recently used normalized values with hit, miss and eviction counts
+
+    One cache is shared by reviews and Find Duplicates so each field is only
+    cleaned up once. Stripped fields are keyed by ("field", note id, mod,
+    field number) so edits are picked up, the engines' own preprocessing by
+    the engine and the value.
+
+    >>> cache = NormalizationCache(maxsize=2)
+    >>> [cache.get(key, str.upper, key) for key in ["a", "b", "a", "c"]]
+    ['A', 'B', 'A', 'C']
+    >>> cache.stats()
+    {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 3, 'evictions': 1}
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values: "OrderedDict[Hashable, Any]" = OrderedDict()
+        # matching also runs on background threads
+        self._lock = threading.Lock()
+
+        # parallel_test's workers are forked from Anki, maybe while another
+        # thread holds the lock, and would wait on it forever
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def get(self, key: Hashable, function: Callable[[Any], Any], argument: Any) -> Any:
+        """function(argument), computed once for each key"""
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                self._values.move_to_end(key)
+
+                return self._values[key]
+
+        value = function(argument)
+
+        with self._lock:
+            self.misses += 1
+            self._values[key] = value
+            self._evict()
+
+        return value
+
+    def resize(self, maxsize: int) -> None:
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._values),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def reset_stats(self) -> None:
+        self.hits = self.misses = self.evictions = 0
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def _evict(self) -> None:
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+            self.evictions += 1
+
+
+normalization_cache = NormalizationCache()
+
+
+def normalized_field(note_id: int, mod: int, field_number: int, value: str) -> str:
+    """field value without html, cached until the note is modified"""
+    return normalization_cache.get(
+        ("field", note_id, mod, field_number), strip_html, value
+    )
+
+
+def clear_cached_indexes() -> None:
+    """drop the indexes kept over the cousin values seen on every answer
+
+    Find Duplicates builds them over whole note types, which would otherwise
+    stay in memory after the search.
+    """
+    _NgramIndex.cached.cache_clear()
+    _AhoCorasick.cached.cache_clear()
+    _WordIndex.cached.cache_clear()
+
+
+class Comparisons(enum.Enum):
+    similarity = 1
+    prefix = 2
+    contains = 3
+    contained_by = 4
+    cloze_contained_by = 5
+    tfidf = 6
+
+
+# rule scope for the deck being studied. Starts with the field separator so it
+# can't be mistaken for a search typed into the scope box
+CURRENT_DECK = "\x1fcurrent deck"
+
+
+class MatchRule(NamedTuple):
+    my_note_model_id: int
+    my_field: str
+    cousin_note_model_id: int
+    cousin_field: str
+    comparison: Comparisons
+    threshold: float
+
+    # cards cousins are looked for in: everywhere when empty, CURRENT_DECK for
+    # the deck being studied and its children or else an anki search
+    scope: str = ""
+
+    def test(self, a: List[str], b: List[str]) -> List[Tuple[str, str]]:
+        comparison = self.comparison
+
+        if comparison == Comparisons.similarity:
+            return _similarity_test()(a, b, self.threshold)
+        elif comparison == Comparisons.prefix:
+            return _commonPrefixTest(a, b, self.threshold)
+        elif comparison == Comparisons.contains:
+            return _contains(a, b, self.threshold)
+        elif comparison == Comparisons.contained_by:
+            return _contained_by(a, b, self.threshold)
+        elif comparison == Comparisons.cloze_contained_by:
+            return _cloze_contained_by()(a, b, self.threshold)
+        elif comparison == Comparisons.tfidf:
+            return _tfidf_test()(a, b, self.threshold)
+        raise ValueError("unrecognized comparison test")
+
+    @property
+    def incremental(self) -> bool:
+        """whether pairs match regardless of the other values matched with them
+
+        Only then can notes that changed be matched on their own. tf-idf
+        weighs each value by how common its n-grams are among the cousins.
+        """
+        return self.comparison != Comparisons.tfidf
+
+
+class CompiledRule(NamedTuple):
+    rule: MatchRule
+    my_field_number: int
+    cousin_field_number: int
+
+
+class RuleSet:
+    """rules with field names resolved to ordinals, indexed by note type
+
+    >>> models = {1: {"flds": [{"name": "Front", "ord": 0}]},
+    ...           2: {"flds": [{"name": "Text", "ord": 0}, {"name": "Extra", "ord": 1}]}}
+    >>> rule_set = RuleSet(
+    ...     [MatchRule(1, "Front", 2, "Extra", Comparisons.prefix, 0.5),
+    ...      MatchRule(1, "Front", 2, "Extra", Comparisons.similarity, 0.5),
+    ...      MatchRule(1, "Front", 2, "Missing", Comparisons.similarity, 0.5)],
+    ...     models.get)
+    >>> [compiled.rule.comparison.name for compiled in rule_set.for_model(1)]
+    ['prefix', 'similarity']
+
+    >>> {key: len(rules) for key, rules in rule_set.cousin_groups(1).items()}
+    {(2, 1, ''): 2}
+    >>> rule_set.scopes
+    {''}
+    """
+
+    def __init__(self, rules: Iterable[MatchRule], get_model: Callable):
+        self.rules: List[CompiledRule] = []
+        self._cousin_groups: DefaultDict[
+            int, DefaultDict[Tuple[int, int, str], List[CompiledRule]]
+        ] = defaultdict(lambda: defaultdict(list))
+
+        def field_number(model_id: int, field_name: str) -> Optional[int]:
+            model = get_model(model_id)
+
+            if not model:
+                return None
+
+            return next(
+                (f["ord"] for f in model["flds"] if f["name"] == field_name), None
+            )
+
+        for rule in rules:
+            my_field_number = field_number(rule.my_note_model_id, rule.my_field)
+            cousin_field_number = field_number(
+                rule.cousin_note_model_id, rule.cousin_field
+            )
+
+            # note type or field was deleted or renamed after the rule was made
+            if my_field_number is None or cousin_field_number is None:
+                continue
+
+            compiled = CompiledRule(rule, my_field_number, cousin_field_number)
+
+            self.rules.append(compiled)
+            self._cousin_groups[rule.my_note_model_id][
+                (rule.cousin_note_model_id, cousin_field_number, rule.scope)
+            ].append(compiled)
+
+    @property
+    def scopes(self) -> Set[str]:
+        return {compiled.rule.scope for compiled in self.rules}
+
+    def for_model(self, model_id: int) -> List[CompiledRule]:
+        return [
+            compiled
+            for group in self.cousin_groups(model_id).values()
+            for compiled in group
+        ]
+
+    def cousin_groups(
+        self, model_id: int
+    ) -> Dict[Tuple[int, int, str], List[CompiledRule]]:
+        """rules for notes of model_id, grouped by (cousin model id, field, scope)"""
+        return self._cousin_groups.get(model_id, {})  # type: ignore
+
+
+def duplicate_groups(
+    rule: MatchRule,
+    matches: Iterable[Tuple[str, str]],
+    my_mapping: Mapping[str, Sequence[int]],
+    cousin_mapping: Mapping[str, Sequence[int]],
+) -> Dict[str, Set[int]]:
+    """group note ids by the value that matched, the way Find Duplicates lists them
+
+    >>> rule = MatchRule(1, "Front", 1, "Front", Comparisons.prefix, 0.5)
+    >>> duplicate_groups(
+    ...     rule,
+    ...     [("abcde", "abcdf"), ("abcde", "abcde")],
+    ...     {"abcde": [1], "abcdf": [2]},
+    ...     {"abcde": [1], "abcdf": [2]},
+    ... )
+    {'[prefix] abcde': {1, 2}}
+    """
+    groups: DefaultDict[str, Set[int]] = defaultdict(set)
+
+    for my_value, cousin_value in matches:
+        key = f"[{rule.comparison.name}] {my_value}"
+
+        for my_note_id in my_mapping[my_value]:
+            for cousin_note_id in cousin_mapping[cousin_value]:
+                if my_note_id == cousin_note_id:
+                    continue
+
+                groups[key].add(my_note_id)
+                groups[key].add(cousin_note_id)
+
+    return dict(groups)
+
+
+def _commonPrefixTest(
+    list_a: List[str], list_b: List[str], percent_match: float
+) -> List[Tuple[str, str]]:
+    """
+    >>> _commonPrefixTest(['abcdefg'], ['abcdexx'], 0.65)
+    [('abcdefg', 'abcdexx')]
+
+    >>> _commonPrefixTest(['abcdefg'], ['abcdexx'], 0.95)
+    []
+
+    >>> _commonPrefixTest(['abcd'], ['abcdefgh', 'abcx', 'xbcd', 'abcx'], 0.5)
+    [('abcd', 'abcx'), ('abcd', 'abcx')]
+    """
+    # don't accidentally run on empty cards. rather be safe
+    list_a = [a for a in list_a if len(a) >= 4]
+
+    positions: DefaultDict[str, List[int]] = defaultdict(list)
+
+    for j, b in enumerate(list_b):
+        if len(b) >= 4:
+            positions[b].append(j)
+
+    # values sharing a prefix are next to each other once sorted
+    sorted_b = sorted(positions)
+
+    results: List[Tuple[str, str]] = []
+
+    for a in list_a:
+        # a match needs more than percent_match * len(a) common characters so
+        # only values starting with that many characters of a are worth
+        # looking at
+        required = int(percent_match * len(a)) + 1
+
+        if required > len(a):
+            continue
+
+        prefix = a[:required]
+        hits: List[int] = []
+
+        k = bisect_left(sorted_b, prefix)
+
+        while k < len(sorted_b) and sorted_b[k].startswith(prefix):
+            b = sorted_b[k]
+            k += 1
+
+            common = len(commonprefix((a, b)))
+
+            if common > percent_match * max(len(a), len(b)):
+                hits.extend(positions[b])
+
+        # same order as comparing every a against every b
+        hits.sort()
+
+        results.extend((a, list_b[j]) for j in hits)
+
+    return results
+
+
+class _NgramIndex:
+    """inverted index from character n-grams to the values containing them
+
+    Narrows down the values worth running through difflib. Matching blocks of
+    a SequenceMatcher are common substrings, so two values with a ratio of at
+    least the cutoff must share a minimum number of n-grams. Values that share
+    fewer can be skipped without changing the result.
+
+    >>> index = _NgramIndex(['this is a test', 'this is a tent', 'that was it'], 2)
+    >>> sorted(index.candidates('this is a text', 0.8))
+    ['this is a tent', 'this is a test']
+
+    short values get a useless bound and are checked against everything of a
+    compatible length
+
+    >>> sorted(index.candidates('abcd', 0.5))
+    ['that was it']
+    """
+
+    def __init__(self, values: Iterable[str], size: int):
+        self.size = size
+        self._values = list(values)
+        self._postings: DefaultDict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self._by_length: DefaultDict[int, List[int]] = defaultdict(list)
+
+        for i, value in enumerate(self._values):
+            self._by_length[len(value)].append(i)
+
+            for gram, count in self._ngrams(value).items():
+                self._postings[gram].append((i, count))
+
+    @staticmethod
+    def size_for(cutoff: float) -> int:
+        # trigrams are more selective, but their bound only gets positive for
+        # high cutoffs
+        return 3 if cutoff >= 0.9 else 2
+
+    @classmethod
+    @lru_cache(maxsize=4)
+    def cached(cls, values: FrozenSet[str], size: int) -> "_NgramIndex":
+        # cousin values are the same on every answer, so keep the index around
+        return cls(sorted(values), size)
+
+    def _ngrams(self, value: str) -> Counter:
+        size = self.size
+        return Counter(value[i : i + size] for i in range(len(value) - size + 1))
+
+    def _shared_bound(self, total_length: int, cutoff: float) -> float:
+        """minimum number of n-grams shared by values with a ratio >= cutoff
+
+        ratio = 2 * M / T where M is the number of matched characters. The M
+        characters are split across blocks and every block after the first
+        needs at least one unmatched character in front of it so there are at
+        most T - 2M + 1 blocks. Each block loses n - 1 n-grams at most.
+        """
+        # tiny margin so float rounding never prunes a real match
+        matched = cutoff * total_length / 2 - 1e-9
+        return matched - (self.size - 1) * (total_length - 2 * matched + 1)
+
+    def candidates(self, value: str, cutoff: float) -> Iterator[str]:
+        length = len(value)
+
+        required: Dict[int, float] = {}
+        unindexed: List[int] = []
+
+        for other_length in self._by_length:
+            total_length = length + other_length
+
+            # same check as SequenceMatcher.real_quick_ratio
+            if 2.0 * min(length, other_length) / total_length < cutoff:
+                continue
+
+            bound = self._shared_bound(total_length, cutoff)
+
+            if bound > 0:
+                required[other_length] = bound
+            else:
+                unindexed.append(other_length)
+
+        shared: DefaultDict[int, int] = defaultdict(int)
+
+        if required:
+            for gram, count in self._ngrams(value).items():
+                for i, other_count in self._postings.get(gram, ()):
+                    shared[i] += min(count, other_count)
+
+        values = self._values
+
+        for i, n in shared.items():
+            other = values[i]
+            needed = required.get(len(other))
+
+            if needed is not None and n >= needed:
+                yield other
+
+        for other_length in unindexed:
+            for i in self._by_length[other_length]:
+                yield values[i]
+
+
+class _DifflibBackend:
+    """scores the values sharing enough n-grams with difflib
+
+    Same checks as difflib.get_close_matches, without its cap on the number of
+    matches for each value.
+    """
+
+    def matches(
+        self, values_a: List[str], values_b: List[str], cutoff: float
+    ) -> List[Tuple[str, str]]:
+        """(a, b) pairs with a ratio of at least cutoff, in the order of a then b"""
+        index = _NgramIndex.cached(frozenset(values_b), _NgramIndex.size_for(cutoff))
+        positions = {b: j for j, b in enumerate(values_b)}
+
+        results: List[Tuple[str, str]] = []
+
+        for a in values_a:
+            # only score the values that share enough n-grams to reach the
+            # cutoff. difflib would reject the others anyway
+            matcher = _matcher(a)
+            matched = [
+                b for b in index.candidates(a, cutoff) if _close(matcher, b, cutoff)
+            ]
+            matched.sort(key=positions.__getitem__)
+
+            results.extend((a, b) for b in matched)
+
+        return results
+
+
+class _RapidfuzzBackend:
+    """scores every pair with rapidfuzz, then confirms the close ones with difflib
+
+    rapidfuzz's ratio is based on the longest common subsequence, and the
+    matching blocks difflib finds are a common subsequence, so rapidfuzz never
+    scores a pair lower than difflib does. Pairs it rejects can be skipped
+    without changing the result. Raises ImportError without rapidfuzz.
+    """
+
+    # upper bound on the scores held for one block of values, around 20MB
+    max_block_entries = 5_000_000
+
+    # rapidfuzz scores are float32 out of 100, so leave plenty of room
+    margin = 1e-3
+
+    def __init__(self) -> None:
+        from rapidfuzz import fuzz, process
+
+        self._fuzz = fuzz
+        self._process = process
+
+    def matches(
+        self, values_a: List[str], values_b: List[str], cutoff: float
+    ) -> List[Tuple[str, str]]:
+        """(a, b) pairs with a ratio of at least cutoff, in the order of a then b"""
+        if not values_a or not values_b:
+            return []
+
+        score_cutoff = max(0.0, cutoff * 100 - self.margin)
+
+        results: List[Tuple[str, str]] = []
+
+        # replaced before its first use since no value has index -1
+        current, matcher = -1, _matcher("")
+
+        # candidates come in order of a so each matcher is only set up once
+        for i, j in self._candidates(values_a, values_b, score_cutoff):
+            if i != current:
+                current, matcher = i, _matcher(values_a[i])
+
+            if _close(matcher, values_b[j], cutoff):
+                results.append((values_a[i], values_b[j]))
+
+        return results
+
+    def _candidates(
+        self, values_a: List[str], values_b: List[str], score_cutoff: float
+    ) -> Iterator[Tuple[int, int]]:
+        try:
+            import numpy as np
+        except ImportError:
+            # cdist needs numpy, so score one value at a time instead
+            for i, a in enumerate(values_a):
+                found = self._process.extract(
+                    a,
+                    values_b,
+                    scorer=self._fuzz.ratio,
+                    score_cutoff=score_cutoff,
+                    limit=None,
+                )
+                yield from ((i, j) for j in sorted(j for _, _, j in found))
+
+            return
+
+        block_rows = max(1, self.max_block_entries // len(values_b))
+
+        for start in range(0, len(values_a), block_rows):
+            scores = self._process.cdist(
+                values_a[start : start + block_rows],
+                values_b,
+                scorer=self._fuzz.ratio,
+                score_cutoff=score_cutoff,
+            )
+            rows, columns = np.nonzero(scores >= score_cutoff)
+
+            yield from zip((rows + start).tolist(), columns.tolist())
+
+
+def _similarity_backends() -> list:
+    """every backend that can run here, fastest first
+
+    They all find the same pairs.
+
+    >>> import random
+    >>> rng = random.Random(0)
+    >>> values = [
+    ...     "".join(rng.choice("abcd ") for _ in range(rng.randint(4, 40)))
+    ...     for _ in range(100)
+    ... ]
+    >>> for cutoff in (0.6, 0.8, 0.95):
+    ...     expected = _DifflibBackend().matches(values, values, cutoff)
+    ...     for backend in _similarity_backends():
+    ...         assert backend.matches(values, values, cutoff) == expected
+    """
+    backends: list = [_DifflibBackend()]
+
+    try:
+        backends.insert(0, _RapidfuzzBackend())
+    except ImportError:
+        pass
+
+    return backends
+
+
+similarity_backend = _similarity_backends()[0]
+
+
+def _matcher(a: str) -> difflib.SequenceMatcher:
+    # same way around as get_close_matches, which matters for long values
+    # where difflib ignores popular characters
+    matcher = difflib.SequenceMatcher()
+    matcher.set_seq2(a)
+
+    return matcher
+
+
+def _close(matcher: difflib.SequenceMatcher, b: str, cutoff: float) -> bool:
+    matcher.set_seq1(b)
+
+    return (
+        matcher.real_quick_ratio() >= cutoff
+        and matcher.quick_ratio() >= cutoff
+        and matcher.ratio() >= cutoff
+    )
+
+
+class _similarity_test:
+    """
+    >>> _similarity_test()(['xxxyyy'], ['xxyxyy'], 0.8)
+    [('xxxyyy', 'xxyxyy')]
+
+    >>> _similarity_test()(['xxxyyy'], ['xxyxyy'], 0.9)
+    []
+
+    >>> _similarity_test()(['||c1::this|| that'], ['this ||c1::that::noun||'], 0.9)
+    []
+
+    >>> _similarity_test()(['{{c1::this}}&nbsp;that'], ['this {{c1::that::noun}}'], 0.9)
+    [('{{c1::this}}&nbsp;that', 'this {{c1::that::noun}}')]
+
+    >>> _similarity_test()(['hello'], ['hello this is a test'], 0.5)
+    []
+
+    every close value is a match, not only the best 10
+
+    >>> len(_similarity_test()(['abcdefgh'], ['abcdefg' + c for c in 'ijklmnopqrstuv'], 0.8))
+    14
+    """
+
+    @staticmethod
+    def __call__(
+        list_a: List[str], list_b: List[str], percent_match: float
+    ) -> List[Tuple[str, str]]:
+        mapping_a = _similarity_test._transform(list_a)
+        mapping_b = _similarity_test._transform(list_b)
+
+        return [
+            (a, b)
+            for transformed_a, transformed_b in similarity_backend.matches(
+                list(mapping_a), list(mapping_b), percent_match
+            )
+            for a, b in product(mapping_a[transformed_a], mapping_b[transformed_b])
+        ]
+
+    @staticmethod
+    def _transform(list_x: List[str]) -> Dict[str, List[str]]:
+        """ flattened: [original values] """
+        mapping = defaultdict(list)
+
+        for x in list_x:
+            x_ = _similarity_test._preprocess(x)
+
+            # don't accidentally run on empty cards. rather be safe
+
+            if len(x_) >= 4:
+                mapping[x_].append(x)
+
+        return dict(mapping)
+
+    @staticmethod
+    def _preprocess(a: str) -> str:
+        return normalization_cache.get(("similarity", a), _similarity_test._fold, a)
+
+    @staticmethod
+    def _fold(a: str) -> str:
+        # replace html entity that gets frequently entered in cloze cards
+        a = a.replace("&nbsp;", " ")
+
+        return CLOZE_EXTRACT.sub(r"\g<answer>", a).lower()
+
+
+class _AhoCorasick:
+    """automaton matching a fixed set of needles in one pass over a haystack
+
+    >>> automaton = _AhoCorasick(['hers', 'his', 'she', 'he'])
+    >>> sorted(automaton.needles[i] for i in automaton.search('ushers'))
+    ['he', 'hers', 'she']
+
+    >>> sorted(automaton.needles[i] for i in automaton.search('this'))
+    ['his']
+    """
+
+    # below this many needles, python's own substring search is faster than
+    # stepping through the automaton one character at a time
+    min_needles = 64
+
+    def __init__(self, needles: Iterable[str]):
+        self.needles = list(needles)
+
+        goto: List[Dict[str, int]] = [{}]
+        output: List[List[int]] = [[]]
+
+        for i, needle in enumerate(self.needles):
+            state = 0
+
+            for char in needle:
+                next_state = goto[state].get(char)
+
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    output.append([])
+
+                state = next_state
+
+            output[state].append(i)
+
+        # breadth first so failure states are always complete before they're
+        # used to extend deeper ones
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+
+                fail[next_state] = goto[fallback].get(char, 0)
+                output[next_state] = output[next_state] + output[fail[next_state]]
+
+        self._goto = goto
+        self._fail = fail
+        self._output = output
+
+    @classmethod
+    @lru_cache(maxsize=4)
+    def cached(cls, needles: FrozenSet[str]) -> "_AhoCorasick":
+        # in buryCousins, the cousin values are the needles on every answer
+        return cls(sorted(needles))
+
+    def search(self, haystack: str) -> Set[int]:
+        """indexes of the needles found in haystack"""
+        goto, fail, output = self._goto, self._fail, self._output
+
+        found: Set[int] = set()
+        state = 0
+
+        for char in haystack:
+            while state and char not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(char, 0)
+
+            if output[state]:
+                found.update(output[state])
+
+        return found
+
+
+def _contained_by(
+    list_a: List[str], list_b: List[str], threshold: float
+) -> List[Tuple[str, str]]:
+    """
+    >>> _contained_by(['hello', 'bye', 'test'], ['hello world', 'goodbye', 'tests'], 1)
+    [('hello', 'hello world'), ('test', 'tests')]
+    """
+    positions: DefaultDict[str, List[int]] = defaultdict(list)
+
+    for i, a in enumerate(list_a):
+        # don't accidentally run on empty cards. rather be safe
+        if len(a) > 3:
+            positions[a].append(i)
+
+    needles = frozenset(positions)
+
+    if not needles:
+        return []
+
+    if len(needles) < _AhoCorasick.min_needles:
+
+        def find(b: str) -> Iterable[str]:
+            return [needle for needle in needles if needle in b]
+
+    else:
+        automaton = _AhoCorasick.cached(needles)
+
+        def find(b: str) -> Iterable[str]:
+            return [automaton.needles[i] for i in automaton.search(b)]
+
+    hits = [
+        (i, j)
+        for j, b in enumerate(list_b)
+        for needle in find(b)
+        for i in positions[needle]
+    ]
+
+    # same order as comparing every a against every b
+    hits.sort()
+
+    return [(list_a[i], list_b[j]) for i, j in hits]
+
+
+def _contains(
+    list_a: List[str], list_b: List[str], threshold: float
+) -> List[Tuple[str, str]]:
+    """
+    >>> _contains(['hello world', 'goodbye'], ['hello', 'bye'], 1)
+    [('hello world', 'hello')]
+    """
+    return [(a, b) for b, a in _contained_by(list_b, list_a, threshold)]
+
+
+class _WordIndex:
+    """positions of the haystacks containing each word
+
+    Every word of a cloze answer is a whole word wherever \\bANSWER\\b
+    matches, so only haystacks containing all of them need the regex.
+
+    >>> index = _WordIndex(('the cat sat', 'a cat', 'dogs'))
+    >>> sorted(index.candidates('cat sat'))
+    [0]
+    >>> sorted(index.candidates('a cat'))
+    [1]
+    >>> index.candidates('dog')
+    set()
+    >>> index.candidates('...') is None
+    True
+    """
+
+    def __init__(self, haystacks: Sequence[str]):
+        postings: DefaultDict[str, List[int]] = defaultdict(list)
+
+        for j, haystack in enumerate(haystacks):
+            for word in set(WORD.findall(haystack)):
+                postings[word].append(j)
+
+        self._postings = dict(postings)
+
+    @classmethod
+    @lru_cache(maxsize=1)
+    def cached(cls, haystacks: Tuple[str, ...]) -> "_WordIndex":
+        # in buryCousins, the cousin values are the haystacks on every answer
+        return cls(haystacks)
+
+    def candidates(self, answer: str) -> Optional[Set[int]]:
+        """haystacks with every word of answer, or None if it has no words"""
+        words = set(WORD.findall(answer))
+
+        if not words:
+            return None
+
+        postings = sorted((self._postings.get(word, []) for word in words), key=len)
+        found = set(postings[0])
+
+        for posting in postings[1:]:
+            if not found:
+                break
+
+            found.intersection_update(posting)
+
+        return found
+
+
+class _cloze_contained_by:
+    """terms in cloze deletion a contained anywhere in b
+
+    >>> bool(_cloze_contained_by()(['{{c1::hello}}'], ['test hello test'], 1))
+    True
+
+    >>> bool(_cloze_contained_by()(['{{c1::hello::greeting}}'], ['test hello test'], 1))
+    True
+
+    >>> bool(_cloze_contained_by()(['{{c1::hello}}'], ['bye'], 1))
+    False
+
+    >>> bool(_cloze_contained_by()(['Phase {{c1::2::#N}} clinical trial'], ['2 x 2'], 1))
+    False
+
+    >>> bool(_cloze_contained_by()(['{{c1::hello}}'], ['phelloderm'], 1))
+    False
+
+    only haystacks sharing the answers' words are searched
+
+    >>> a = ['{{c1::hello world}} {{c2::good bye}}', '{{c1::world}} {{c2::-(!)-}}',
+    ...      '{{c1::hello}}']
+    >>> b = ['hello world', 'world hello', 'good bye, -(!)-', 'hello']
+    >>> _cloze_contained_by()(a, b, 1) == [
+    ...     (a_, b_) for a_ in a for b_ in b
+    ...     if any(p.search(b_) for _, p in _cloze_contained_by._extra_answers(a_))]
+    True
+    >>> len(_cloze_contained_by()(a, b, 1))
+    7
+    """
+
+    def __call__(
+        self, list_a: List[str], list_b: List[str], threshold: float
+    ) -> List[Tuple[str, str]]:
+        answers = [self._extra_answers(a) for a in list_a]
+
+        index = None
+
+        # even one answer is worth indexing for, since reviews test a single
+        # note against the same cousin values on every answer
+        if list_b and any(answers):
+            index = _WordIndex.cached(tuple(list_b))
+
+        everywhere = range(len(list_b))
+        results: List[Tuple[str, str]] = []
+
+        for a, a_answers in zip(list_a, answers):
+            found: Set[int] = set()
+
+            for answer, pattern in a_answers:
+                candidates = None if index is None else index.candidates(answer)
+
+                found.update(
+                    j
+                    for j in (everywhere if candidates is None else candidates)
+                    if j not in found and pattern.search(list_b[j])
+                )
+
+            results.extend((a, list_b[j]) for j in sorted(found))
+
+        return results
+
+    @staticmethod
+    def _extra_answers(a: str) -> List[Tuple[str, re.Pattern]]:
+        # cached so for each a vs b comparison we don't re-extract answers
+        # from a
+        return normalization_cache.get(
+            ("cloze", a), _cloze_contained_by._compile_answers, a
+        )
+
+    @staticmethod
+    def _compile_answers(a: str) -> List[Tuple[str, re.Pattern]]:
+        """(answer, pattern matching it as whole words)"""
+        return [
+            (answer, re.compile(r"\b{}\b".format(re.escape(answer))))
+            for answer in (match.group("answer") for match in CLOZE_EXTRACT.finditer(a))
+            # don't accidentally suppress on concepts like "2"
+            if len(answer) > 3
+        ]
+
+
+class _tfidf_test:
+    """cosine similarity of tf-idf weighted character n-grams
+
+    Meant for finding duplicates across a whole note type where comparing
+    every pair with difflib takes too long. Uses sparse matrix products from
+    numpy and scipy when they're installed and an inverted index otherwise.
+
+    >>> _tfidf_test()(['the quick brown fox'], ['the quick brown fax', 'a slow red dog'], 0.6)
+    [('the quick brown fox', 'the quick brown fax')]
+
+    >>> _tfidf_test()(['{{c1::this}}&nbsp;that'], ['this {{c1::that::noun}}'], 0.99)
+    [('{{c1::this}}&nbsp;that', 'this {{c1::that::noun}}')]
+
+    the weights only come from b, so splitting a up like parallel_test does
+    finds the same pairs
+
+    >>> b = ['one two three', 'one two four', 'five six seven', 'one too three']
+    >>> a = b + ['one two', 'six seven eight', 'two three four']
+    >>> serial = _tfidf_test()(a, b, 0.5)
+    >>> serial == [pair for i in range(0, len(a), 2)
+    ...            for pair in _tfidf_test()(a[i : i + 2], b, 0.5)]
+    True
+    >>> len(serial)
+    9
+
+    both implementations find the same pairs
+
+    >>> a = ['one two three', 'four five six', 'seven eight nine', 'one two tree']
+    >>> _tfidf_test._python_pairs(*_tfidf_test._vectors(a, a), 0.5)
+    [(0, 0), (0, 3), (1, 1), (2, 2), (3, 0), (3, 3)]
+    >>> try:
+    ...     pairs = _tfidf_test._numpy_pairs(*_tfidf_test._vectors(a, a), 0.5)
+    ... except ImportError:
+    ...     pairs = _tfidf_test._python_pairs(*_tfidf_test._vectors(a, a), 0.5)
+    >>> pairs
+    [(0, 0), (0, 3), (1, 1), (2, 2), (3, 0), (3, 3)]
+
+    including when no value shares an n-gram with any cousin
+
+    >>> vectors = _tfidf_test._vectors(['a totally unrelated note'], ['xyzw qqqq'])
+    >>> _tfidf_test._python_pairs(*vectors, 0.8)
+    []
+    >>> try:
+    ...     pairs = _tfidf_test._numpy_pairs(*vectors, 0.8)
+    ... except ImportError:
+    ...     pairs = _tfidf_test._python_pairs(*vectors, 0.8)
+    >>> pairs
+    []
+    """
+
+    ngram_size = 3
+
+    # upper bound on the entries of one block of products, around 80MB
+    max_block_entries = 5_000_000
+
+    # absorb float rounding so both implementations agree on the threshold
+    epsilon = 1e-9
+
+    def __call__(
+        self, list_a: List[str], list_b: List[str], threshold: float
+    ) -> List[Tuple[str, str]]:
+        mapping_a = _similarity_test._transform(list_a)
+        mapping_b = _similarity_test._transform(list_b)
+
+        if not mapping_a or not mapping_b:
+            return []
+
+        keys_a = list(mapping_a)
+        keys_b = list(mapping_b)
+
+        vectors = self._vectors(keys_a, keys_b)
+
+        try:
+            pairs = self._numpy_pairs(*vectors, threshold)
+        except ImportError:
+            pairs = self._python_pairs(*vectors, threshold)
+
+        return [
+            (a, b)
+            for i, j in pairs
+            for a, b in product(mapping_a[keys_a[i]], mapping_b[keys_b[j]])
+        ]
+
+    @classmethod
+    def _ngrams(cls, value: str) -> Counter:
+        size = cls.ngram_size
+        return Counter(value[i : i + size] for i in range(len(value) - size + 1))
+
+    @classmethod
+    def _vectors(
+        cls, keys_a: List[str], keys_b: List[str]
+    ) -> Tuple[List[Dict[int, float]], List[Dict[int, float]]]:
+        """unit length tf-idf vectors over n-gram ids, idf from keys_b
+
+        Weighing by b alone keeps the score of a pair the same however a is
+        split up, like across parallel_test's processes.
+        """
+        counts_a = [cls._ngrams(key) for key in keys_a]
+        counts_b = [cls._ngrams(key) for key in keys_b]
+
+        document_frequency: Counter = Counter()
+        for counts in counts_b:
+            document_frequency.update(counts.keys())
+
+        ids = {gram: i for i, gram in enumerate(document_frequency)}
+
+        # smoothed like scikit-learn so grams in every value still count a bit
+        def idf(gram: str) -> float:
+            return math.log((1 + len(keys_b)) / (1 + document_frequency[gram])) + 1
+
+        def vector(counts: Counter) -> Dict[int, float]:
+            weights = {gram: count * idf(gram) for gram, count in counts.items()}
+            norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+
+            # grams missing from b can't add to any score, only to the norm
+            return {
+                ids[gram]: weight / norm
+                for gram, weight in weights.items()
+                if gram in ids
+            }
+
+        return [vector(c) for c in counts_a], [vector(c) for c in counts_b]
+
+    @classmethod
+    def _python_pairs(
+        cls,
+        vectors_a: List[Dict[int, float]],
+        vectors_b: List[Dict[int, float]],
+        threshold: float,
+    ) -> List[Tuple[int, int]]:
+        postings: DefaultDict[int, List[Tuple[int, float]]] = defaultdict(list)
+
+        for j, vector in enumerate(vectors_b):
+            for gram, weight in vector.items():
+                postings[gram].append((j, weight))
+
+        pairs: List[Tuple[int, int]] = []
+
+        for i, vector in enumerate(vectors_a):
+            scores: DefaultDict[int, float] = defaultdict(float)
+
+            for gram, weight in vector.items():
+                for j, other_weight in postings.get(gram, ()):
+                    scores[j] += weight * other_weight
+
+            pairs.extend(
+                (i, j) for j in sorted(scores) if scores[j] >= threshold - cls.epsilon
+            )
+
+        return pairs
+
+    @classmethod
+    def _numpy_pairs(
+        cls,
+        vectors_a: List[Dict[int, float]],
+        vectors_b: List[Dict[int, float]],
+        threshold: float,
+    ) -> List[Tuple[int, int]]:
+        import numpy as np
+        from scipy import sparse  # type: ignore
+
+        # n-gram ids come from b, so every id is in one of its vectors
+        width = 1 + max((max(vector) for vector in vectors_b if vector), default=-1)
+
+        def matrix(vectors: List[Dict[int, float]]):
+            sizes = np.fromiter(map(len, vectors), dtype=np.int64, count=len(vectors))
+            indptr = np.concatenate(([0], np.cumsum(sizes)))
+            indices = np.fromiter(
+                chain.from_iterable(vectors), dtype=np.int64, count=indptr[-1]
+            )
+            data = np.fromiter(
+                chain.from_iterable(v.values() for v in vectors),
+                dtype=np.float64,
+                count=indptr[-1],
+            )
+
+            # the shape can't be inferred when no vector has an n-gram
+            return sparse.csr_matrix(
+                (data, indices, indptr), shape=(len(vectors), width)
+            )
+
+        matrix_a = matrix(vectors_a)
+        matrix_b_t = sparse.csr_matrix(matrix(vectors_b).T)
+
+        # enough rows of a that one block of products stays bounded
+        block_rows = max(1, cls.max_block_entries // len(vectors_b))
+
+        pairs: List[Tuple[int, int]] = []
+
+        for start in range(0, len(vectors_a), block_rows):
+            block = (matrix_a[start : start + block_rows] @ matrix_b_t).tocoo()
+            found = block.data >= threshold - cls.epsilon
+
+            rows = block.row[found] + start
+            columns = block.col[found]
+            order = np.lexsort((columns, rows))
+
+            pairs.extend(zip(rows[order].tolist(), columns[order].tolist()))
+
+        return pairs
@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+from typing import TYPE_CHECKING, Any, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from .matching import MatchRule  # noqa: F401
+
+# below this many comparisons, starting the processes costs more than it saves
+MIN_PARALLEL_COMPARISONS = 2_000_000
+
+# chunks per worker so a slow chunk doesn't leave the other workers idle
+CHUNKS_PER_WORKER = 4
+
+# set in each worker so the cousin values are only sent once per process
+_rule: Optional["MatchRule"] = None
+_cousin_values: Sequence[str] = ()
+
+
+def default_workers() -> int:
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def parallel_test(
+    rule: "MatchRule", my_values: List[str], cousin_values: List[str], workers: int
+) -> List[Tuple[str, str]]:
+    """rule.test with my_values sharded across a pool of processes
+
+    Results come back in the order of the shards so they don't depend on
+    which worker finishes first. Falls back to running in this process for
+    small inputs, outside linux or when processes can't be started.
+    """
+    if workers <= 0:
+        workers = default_workers()
+
+    if workers == 1 or len(my_values) * len(cousin_values) < MIN_PARALLEL_COMPARISONS:
+        return rule.test(my_values, cousin_values)
+
+    context = _context()
+
+    if context is None:
+        return rule.test(my_values, cousin_values)
+
+    # duplicates would be matched again in every shard they land in
+    distinct_values = list(dict.fromkeys(my_values))
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(rule, cousin_values),
+        ) as pool:
+            return [
+                pair
+                for shard_result in pool.map(
+                    _test_shard, _shards(distinct_values, workers * CHUNKS_PER_WORKER)
+                )
+                for pair in shard_result
+            ]
+    except (OSError, RuntimeError, pickle.PicklingError):
+        # includes BrokenProcessPool when a worker dies
+        return rule.test(my_values, cousin_values)
+
+
+def _context() -> Any:
+    """how to start workers, None to run in this process"""
+    # forking a process with threads is only dependable on linux. macOS
+    # system libraries, Qt's among them, can crash in the child, and spawning
+    # a frozen Anki would launch another copy of Anki
+    if not sys.platform.startswith("linux"):
+        return None
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+
+    # workers inherit the loaded add-on instead of importing it again
+    return multiprocessing.get_context("fork")
+
+
+def _shards(values: List[str], count: int) -> List[List[str]]:
+    """
+    >>> _shards(['a', 'b', 'c', 'd', 'e'], 2)
+    [['a', 'b', 'c'], ['d', 'e']]
+
+    >>> _shards(['a'], 4)
+    [['a']]
+    """
+    size = max(1, ceil(len(values) / count))
+
+    return [values[i : i + size] for i in range(0, len(values), size)]
+
+
+def _init_worker(rule: "MatchRule", cousin_values: Sequence[str]) -> None:
+    global _rule, _cousin_values
+
+    # locks held by other threads of Anki at the fork are replaced in the
+    # child, see NormalizationCache
+    _rule = rule
+    _cousin_values = cousin_values
+
+
+def _test_shard(my_values: List[str]) -> List[Tuple[str, str]]:
+    assert _rule is not None
+
+    return _rule.test(my_values, list(_cousin_values))